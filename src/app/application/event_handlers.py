@@ -41,8 +41,8 @@ class SecurityCreatedEventHandler(EventHandler):
     def handle(self, event: SecurityCreatedEvent):
         """ Handle the event """
         sec = event.security
-        logging.debug(f'SecurityCreatedEventHandler event: {event} type {type(event)}')
-        logging.debug(f'SecurityCreatedEventHandler sec: {sec} type {type(sec)}')
+        logging.debug('SecurityCreatedEventHandler event: %s type %s', event, type(event))
+        logging.debug('SecurityCreatedEventHandler sec: %s type %s', sec, type(sec))
         
         # Some have difficult lw_id's ... these ones are not held anyway, so do not need to be included
         if '/' in sec.lw_id:
@@ -180,7 +180,7 @@ class PriceBatchCreatedEventHandler(EventHandler):
         Returns:
         - str: Translated source.
         """
-        if source.name[:3] == 'BB_' and '_DERIVED' not in source.name:
+        if source.name.startswith('BB_') and '_DERIVED' not in source.name:
             return PriceSource('BLOOMBERG')
         elif source.name == 'FTSETMX_PX':
             return PriceSource('FTSE')
@@ -127,7 +127,7 @@ class PriceCountBySourceQueryHandler:
         for swp in held_secs_with_prices:
             if sec_type is not None:
                 try:
-                    logging.debug(f'Checking whether {swp} is sec type {sec_type}')
+                    logging.debug('Checking whether %s is sec type %s', swp, sec_type)
                     if not swp.security.is_sec_type(sec_type):
                         continue  # Skip, as it is not of requested sec type
                 except TypeError as e:
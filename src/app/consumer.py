@@ -6,6 +6,7 @@ import datetime
 import logging
 import os
 import sys
+import threading
 
 # pypi
 
@@ -15,23 +16,23 @@ src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(src_dir)
 
 # native
-from application.event_handlers import (
+from app.application.event_handlers import (
     PriceBatchCreatedEventHandler, AppraisalBatchCreatedEventHandler
     , SecurityCreatedEventHandler, PortfolioCreatedEventHandler, PositionEventHandler
 )
 
-from infrastructure.event_publishers import (
+from app.infrastructure.event_publishers import (
     KafkaCoreDBPositionEventProducer, KafkaCoreDBPortfolioCreatedEventProducer
 )
-from infrastructure.event_subscribers import (
+from app.infrastructure.event_subscribers import (
     KafkaCoreDBAppraisalBatchCreatedEventConsumer
     , KafkaCoreDBPriceBatchCreatedEventConsumer, KafkaCoreDBSecurityCreatedEventConsumer
     , KafkaAPXPortfolioEventConsumer, KafkaAPXPositionEventConsumer
 )
-from infrastructure.file_repositories import (
+from app.infrastructure.file_repositories import (
     JSONHeldSecuritiesRepository, JSONHeldSecuritiesWithPricesRepository, JSONSecurityWithPricesRepository
 )
-from infrastructure.sql_repositories import (
+from app.infrastructure.sql_repositories import (
     CoreDBPriceRepository, CoreDBSecurityRepository
     , LWDBAPXAppraisalPositionRepository
     , CoreDBPriceBatchRepository, CoreDBPriceAuditEntryRepository
@@ -39,9 +40,14 @@ from infrastructure.sql_repositories import (
     , CoreDBPositionRepository, CoreDBLiveHeldSecurityRepository
     , CoreDBPortfolioRepository
 )
-from infrastructure.util.config import AppConfig
-from infrastructure.util.file import prepare_dated_file_path
-from infrastructure.util.logging import setup_logging
+from app.infrastructure.util.config import AppConfig
+from app.infrastructure.util.file import prepare_dated_file_path
+from app.infrastructure.util.logging import setup_logging
+
+
+# Data types whose handlers can run on more than one consumer thread at once. 
+# The others all read-modify-write the same JSON read model files.
+_CONCURRENT_SAFE_DATA_TYPES = ('portfolio',)
 
 
 def main():
@@ -54,75 +60,105 @@ def main():
     parser.add_argument('--reset_offset', '-ro', action='store_true', default=False, help='Reset consumer offset to beginning')
     parser.add_argument('--log_level', '-l', type=str.upper, choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'], help='Log level')
     parser.add_argument('--refresh_prices', '-rp', type=str, required=False, help='Refresh prices for date, YYYYMMDD format')
+    parser.add_argument('--num_workers', '-nw', type=int, default=1
+        , help='Number of consumer threads. Partitions are distributed between them by the consumer group. '
+            f'Only allowed for data types whose handlers are safe to run concurrently: {", ".join(_CONCURRENT_SAFE_DATA_TYPES)}')
     
     args = parser.parse_args()
+    if args.num_workers > 1 and args.data_type not in _CONCURRENT_SAFE_DATA_TYPES:
+        parser.error(f'--num_workers > 1 is not supported for {args.data_type}, since its handler writes shared read models')
     
     if args.data_type == 'appraisal-batch':
-        kafka_consumer = KafkaCoreDBAppraisalBatchCreatedEventConsumer(
-            event_handler = AppraisalBatchCreatedEventHandler(
-                position_repository = LWDBAPXAppraisalPositionRepository()
-                , held_securities_with_prices_repository = JSONHeldSecuritiesWithPricesRepository()
+        def create_kafka_consumer():
+            return KafkaCoreDBAppraisalBatchCreatedEventConsumer(
+                event_handler = AppraisalBatchCreatedEventHandler(
+                    position_repository = LWDBAPXAppraisalPositionRepository()
+                    , held_securities_with_prices_repository = JSONHeldSecuritiesWithPricesRepository()
+                )
             )
-        )
-        log_file = prepare_dated_file_path(AppConfig().parser.get("logging", "log_dir"), datetime.date.today(), AppConfig().parser.get("logging", "kafka_consumer_appraisal_batch_logfile"))
-        setup_logging(args.log_level, log_file)
-        logging.info(f'Consuming appraisal batches...')
-        kafka_consumer.consume(reset_offset=args.reset_offset)
+        log_file_key, description = 'kafka_consumer_appraisal_batch_logfile', 'appraisal batches'
     elif args.data_type == 'price-batch':
-        kafka_consumer = KafkaCoreDBPriceBatchCreatedEventConsumer(
-            event_handler = PriceBatchCreatedEventHandler(
-                price_repository = CoreDBPriceRepository()
-                , security_repository = CoreDBSecurityRepository()
-                , audit_trail_repository = CoreDBPriceAuditEntryRepository()
-                , security_with_prices_repository = JSONSecurityWithPricesRepository()
-                , held_securities_with_prices_repository = JSONHeldSecuritiesWithPricesRepository()
+        def create_kafka_consumer():
+            return KafkaCoreDBPriceBatchCreatedEventConsumer(
+                event_handler = PriceBatchCreatedEventHandler(
+                    price_repository = CoreDBPriceRepository()
+                    , security_repository = CoreDBSecurityRepository()
+                    , audit_trail_repository = CoreDBPriceAuditEntryRepository()
+                    , security_with_prices_repository = JSONSecurityWithPricesRepository()
+                    , held_securities_with_prices_repository = JSONHeldSecuritiesWithPricesRepository()
+                )
             )
-        )
-        log_file = prepare_dated_file_path(AppConfig().parser.get("logging", "log_dir"), datetime.date.today(), AppConfig().parser.get("logging", "kafka_consumer_price_batch_logfile"))
-        setup_logging(args.log_level, log_file)
-        logging.info(f'Consuming price batches...')
-        kafka_consumer.consume(reset_offset=args.reset_offset)
+        log_file_key, description = 'kafka_consumer_price_batch_logfile', 'price batches'
     elif args.data_type == 'security':
-        kafka_consumer = KafkaCoreDBSecurityCreatedEventConsumer(
-            event_handler = SecurityCreatedEventHandler(
-                price_repository = CoreDBPriceRepository()
-                , audit_trail_repository = CoreDBPriceAuditEntryRepository()
-                , security_with_prices_repository = JSONSecurityWithPricesRepository()
-                , held_securities_with_prices_repository = JSONHeldSecuritiesWithPricesRepository()
+        def create_kafka_consumer():
+            return KafkaCoreDBSecurityCreatedEventConsumer(
+                event_handler = SecurityCreatedEventHandler(
+                    price_repository = CoreDBPriceRepository()
+                    , audit_trail_repository = CoreDBPriceAuditEntryRepository()
+                    , security_with_prices_repository = JSONSecurityWithPricesRepository()
+                    , held_securities_with_prices_repository = JSONHeldSecuritiesWithPricesRepository()
+                )
             )
-        )
-        log_file = prepare_dated_file_path(AppConfig().parser.get("logging", "log_dir"), datetime.date.today(), AppConfig().parser.get("logging", "kafka_consumer_security_logfile"))
-        setup_logging(args.log_level, log_file)
-        logging.info(f'Consuming securities...')
-        kafka_consumer.consume(reset_offset=args.reset_offset)
+        log_file_key, description = 'kafka_consumer_security_logfile', 'securities'
     elif args.data_type == 'portfolio':
-        kafka_consumer = KafkaAPXPortfolioEventConsumer(
-            event_handler = PortfolioCreatedEventHandler(
-                portfolio_repo = CoreDBPortfolioRepository()
+        def create_kafka_consumer():
+            return KafkaAPXPortfolioEventConsumer(
+                event_handler = PortfolioCreatedEventHandler(
+                    portfolio_repo = CoreDBPortfolioRepository()
+                )
+                , portfolio_repository = APXDBPortfolioRepository()
             )
-            , portfolio_repository = APXDBPortfolioRepository()
-        )
-        log_file = prepare_dated_file_path(AppConfig().parser.get("logging", "log_dir"), datetime.date.today(), AppConfig().parser.get("logging", "kafka_consumer_portfolio_logfile"))
-        setup_logging(args.log_level, log_file)
-        logging.info(f'Consuming portfolios...')
-        kafka_consumer.consume(reset_offset=args.reset_offset)
+        log_file_key, description = 'kafka_consumer_portfolio_logfile', 'portfolios'
     elif args.data_type == 'position':
-        kafka_consumer = KafkaAPXPositionEventConsumer(
-            event_handler = PositionEventHandler(
-                position_repo = CoreDBPositionRepository()
-                , security_repo = CoreDBSecurityRepository()
-                , held_securities_repo = CoreDBLiveHeldSecurityRepository()
-                , held_securities_with_prices_repo = JSONHeldSecuritiesWithPricesRepository()
+        def create_kafka_consumer():
+            return KafkaAPXPositionEventConsumer(
+                event_handler = PositionEventHandler(
+                    position_repo = CoreDBPositionRepository()
+                    , security_repo = CoreDBSecurityRepository()
+                    , held_securities_repo = CoreDBLiveHeldSecurityRepository()
+                    , held_securities_with_prices_repo = JSONHeldSecuritiesWithPricesRepository()
+                )
             )
-        )
-        log_file = prepare_dated_file_path(AppConfig().parser.get("logging", "log_dir"), datetime.date.today(), AppConfig().parser.get("logging", "kafka_consumer_position_logfile"))
-        setup_logging(args.log_level, log_file)
-        logging.info(f'Consuming positions...')
-        kafka_consumer.consume(reset_offset=args.reset_offset)
+        log_file_key, description = 'kafka_consumer_position_logfile', 'positions'
     else:
         logging.error(f"Unconfigured data_type: {args.data_type}!")
         return 1
 
+    log_file = prepare_dated_file_path(AppConfig().parser.get("logging", "log_dir"), datetime.date.today(), AppConfig().parser.get("logging", log_file_key))
+    setup_logging(args.log_level, log_file)
+    def run_kafka_consumer():
+        with create_kafka_consumer() as kafka_consumer:
+            kafka_consumer.consume(reset_offset=args.reset_offset)
+
+    if args.num_workers <= 1:
+        logging.info(f'Consuming {description}...')
+        run_kafka_consumer()
+        return
+
+    # Multiple workers: each gets its own Consumer in the same consumer group,
+    # so Kafka distributes the topic partitions between them.
+    logging.info(f'Consuming {description} with {args.num_workers} workers...')
+    kafka_consumers = [create_kafka_consumer() for _ in range(args.num_workers)]
+    def run_worker(kafka_consumer):
+        with kafka_consumer:
+            kafka_consumer.consume(reset_offset=args.reset_offset)
+    workers = [
+        threading.Thread(target=run_worker, args=(kc,), name=f'{args.data_type}-consumer-{i}')
+        for i, kc in enumerate(kafka_consumers)
+    ]
+    for w in workers:
+        w.start()
+    try:
+        for w in workers:
+            w.join()
+    except KeyboardInterrupt:
+        # Signals are only delivered to the main thread, so ask each worker to finish its current batch.
+        # Each worker closes its own consumer on the way out, so there is no need to close them here.
+        logging.info(f'Stopping {len(workers)} workers...')
+        for kc in kafka_consumers:
+            kc.stop()
+        for w in workers:
+            w.join()
 
 
 if __name__ == '__main__':
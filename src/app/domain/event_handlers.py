@@ -1,16 +1,13 @@
 
 # core python
-from abc import ABC, abstractmethod
-from typing import List
+from typing import Protocol
 
 # native
 from app.domain.events import Event
 
 
-class EventHandler(ABC):
+class EventHandler(Protocol):
     
-    @abstractmethod
     def handle(self, event: Event):
         """ Event handlers must handle a Event """
 
-
@@ -1,7 +1,6 @@
 
 # core python
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
 from typing import List, Type
 
 # native
@@ -9,8 +8,9 @@ from app.domain.events import Event
 from app.domain.message_brokers import MessageBroker
 
 
-@dataclass
 class EventPublisher(ABC):
-    message_broker: Type[MessageBroker]
-    topics: List[str]
+
+    def __init__(self, message_broker: Type[MessageBroker], topics: List[str]):
+        self.message_broker = message_broker
+        self.topics = topics
 
@@ -1,7 +1,6 @@
 
 # core python
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
 from typing import List, Type
 
 # native
@@ -10,10 +9,10 @@ from app.domain.event_handlers import EventHandler
 from app.domain.message_brokers import MessageBroker
 
 
-@dataclass
 class EventSubscriber(ABC):
-    message_broker: Type[MessageBroker]
-    topics: List[str]
-    event_handler: Type[EventHandler]
 
+    def __init__(self, message_broker: Type[MessageBroker], topics: List[str], event_handler: Type[EventHandler]):
+        self.message_broker = message_broker
+        self.topics = topics
+        self.event_handler = event_handler
 
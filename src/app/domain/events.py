@@ -14,39 +14,55 @@ from app.domain.models import (
 
 class Event(ABC):
     """ Base class for domain events """
+    # Events are created per consumed message, so subclasses use slots rather than a per-instance __dict__
+    __slots__ = ()
 
 
 @dataclass
 class PriceCreatedEvent(Event):
+    __slots__ = ('price',)
+
     price: Price
 
 
 @dataclass
 class PriceBatchCreatedEvent(Event):
+    __slots__ = ('price_batch',)
+
     price_batch: PriceBatch
 
 
 @dataclass
 class AppraisalBatchCreatedEvent(Event):
+    __slots__ = ('appraisal_batch',)
+
     appraisal_batch: AppraisalBatch
 
 
 @dataclass
 class SecurityCreatedEvent(Event):
+    __slots__ = ('security',)
+
     security: Security
 
 
 @dataclass
 class PortfolioCreatedEvent(Event):
+    __slots__ = ('portfolio',)
+
     portfolio: Portfolio
 
 
 @dataclass
 class PositionCreatedEvent(Event):
+    __slots__ = ('position',)
+
     position: Position
 
 
 @dataclass
 class PositionDeletedEvent(Event):
+    __slots__ = ('position',)
+
     position: Position
     
@@ -1,12 +1,11 @@
 
 # core python
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
 
 
-@dataclass
 class MessageBroker(ABC):
     """ Base class for message queues/brokers """
-    config: dict
 
+    def __init__(self, config: dict):
+        self.config = config
 
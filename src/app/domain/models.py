@@ -1,6 +1,7 @@
 # core python
 from dataclasses import dataclass, field
 import datetime
+import functools
 import math
 from typing import List, Type, Union
 
@@ -15,42 +16,101 @@ class InvalidDictError(Exception):
     pass
 
 
-@dataclass
+# Bound once, since the from_dict methods call these for every record
+_date_fromisoformat = datetime.date.fromisoformat
+_datetime_fromisoformat = datetime.datetime.fromisoformat
+
+
+@functools.lru_cache(maxsize=1024)
+def date_isoformat(d: datetime.date) -> str:
+    """ Cached isoformat for dates, since many prices share the same data_date """
+    return d.isoformat()
+
+
+def _is_nan(v) -> bool:
+    """ Whether v is NaN, of any numeric type. The common types are checked without calling math.isnan """
+    if isinstance(v, float):
+        return v != v  # NaN is the only float not equal to itself. Covers np.float64, which subclasses float.
+    if v is None or isinstance(v, (str, int)):
+        return False
+    try:
+        return math.isnan(v)  # e.g. np.float32, Decimal
+    except TypeError:
+        return False  # e.g. "must be real number, not dict"
+
+
+# Price source hierarchy: top in the hierarchy is at the top. TODO: add others not required for pricing revamp?
+PRICE_SOURCE_HIERARCHY = [
+    'OVERRIDE'
+    , 'MANUAL'
+    , 'FUNDRUN'
+    , 'FTSE'
+    , 'MARKIT'
+    , 'BLOOMBERG'
+    , 'RBC'
+]
+
+# Rank of each source in the hierarchy (lower is better), for O(1) lookups when comparing
+_RANK = {name: i for i, name in enumerate(PRICE_SOURCE_HIERARCHY)}
+_UNRANKED = len(PRICE_SOURCE_HIERARCHY)  # sources not in the hierarchy rank below all others
+
+
+def _price_rank(price) -> int:
+    """ Rank of a Price's source in the hierarchy, for use as a sort/min key """
+    return _RANK.get(price.source.name, _UNRANKED)
+
+
+@dataclass(eq=False)
 class PriceSource:
+    __slots__ = ('name',)
+
     name: str  # TODO: enforce that the name must be in the hierarchy?
 
-    # Top in the hierarchy is at the top. TODO: add others not required for pricing revamp?
-    # HIERARCHY: List[str] = [
-    #     'OVERRIDE'
-    #     ,'MANUAL'
-    #     ,'FUNDRUN'
-    #     ,'FTSE'
-    #     ,'MARKIT'
-    #     ,'BLOOMBERG'
-    #     ,'RBC'
-    # ]
+    # Value semantics on the name alone. Cheaper than the dataclass-generated tuple comparison,
+    # and makes instances hashable so they can be used as dict keys / in sets.
+    def __eq__(self, other):
+        return type(other) is type(self) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
 
     def __gt__(self, other):
-        HIERARCHY = [
-            'OVERRIDE'
-            , 'MANUAL'
-            , 'FUNDRUN'
-            , 'FTSE'
-            , 'MARKIT'
-            , 'BLOOMBERG'
-            , 'RBC'
-        ]
-        if self.name not in HIERARCHY:
-            return False
-        elif other.name not in HIERARCHY:
-            return True
-        return (HIERARCHY.index(self.name) < HIERARCHY.index(other.name))
+        return _RANK.get(self.name, _UNRANKED) < _RANK.get(other.name, _UNRANKED)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def of(cls, name: str):
+        """ Get a shared instance for the provided name, since there are only a handful of sources.
+        Callers should not mutate the result. """
+        return cls(name)
 
 
-@dataclass
+@dataclass(eq=False)
 class PriceType:
+    __slots__ = ('name',)
+
     name: str
 
+    def __eq__(self, other):
+        return type(other) is type(self) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def of(cls, name: str):
+        """ Get a shared instance for the provided name, since there are only a handful of types
+        (price/yield/duration/...). Callers should not mutate the result. """
+        return cls(name)
+
+
+# Sec type prefixes (first 2 chars of pms_sec_type) making up each group of sec types
+_SEC_TYPE_GROUPS = {
+    'bond': frozenset({'cb', 'cf', 'cm', 'cv', 'fr', 'lb', 'ln', 'sf', 'tb', 'vm'}),
+    'equity': frozenset({'cc', 'ce', 'cg', 'ch', 'ci', 'cj', 'ck', 'cn', 'cr', 'cs', 'ct', 'cu', 'ps'}),
+}
+
 
 @dataclass
 class Security:
@@ -64,23 +124,21 @@ class Security:
     def __post_init__(self):
         # Replace np.nan and similar attributes with None.
         # This helps avoid issues when JSON (de)serializing "NaN"
-        for (k, v) in self.attributes.items():
-            try:
-                if math.isnan(v):
-                    new_dict_item = {k: None}
-                    self.attributes.update(new_dict_item)
-            except TypeError:  # as e:
-                continue  # e.g. "must be real number, not str"
+        self.attributes = {k: (None if _is_nan(v) else v) for k, v in self.attributes.items()}
 
     def to_dict(self):
         """ Export an instance to dict format """
         res = {'lw_id': self.lw_id}
-        res.update(self.attributes)
 
-        # Add 'apx_xxx' for any 'pms_xxx' keys
+        # Add 'apx_xxx' for any 'pms_xxx' keys. The pms_ value takes precedence over an existing apx_ one.
         # TODO_LAYER: move this to application/infra layers
-        apx_dict = {('apx_' + k[4:]): v for k, v in res.items() if k[:4] == 'pms_'}
-        res.update(apx_dict)
+        attributes = self.attributes
+        for k, v in attributes.items():
+            if k.startswith('pms_'):
+                res[k] = v
+                res['apx_' + k[4:]] = v
+            elif not (k.startswith('apx_') and ('pms_' + k[4:]) in attributes):
+                res[k] = v
 
         return res
 
@@ -88,12 +146,16 @@ class Security:
     def from_dict(cls, data: dict):
         """ Create an instance from dict """
         try:
-            lw_id = data['lw_id']
-            attributes = {key: value for key, value in data.items() if key != 'lw_id'}
-            # Add 'pms_xxx' for any 'apx_xxx' keys
+            # Add 'pms_xxx' for any 'apx_xxx' keys. The apx_ value takes precedence over an existing pms_ one.
             # TODO_LAYER: move this to application/infra layers
-            pms_dict = {('pms_' + k[4:]): v for k, v in attributes.items() if k[:4] == 'apx_'}
-            attributes.update(pms_dict)
+            attributes = {}
+            for k, v in data.items():
+                if k.startswith('apx_'):
+                    attributes[k] = v
+                    attributes['pms_' + k[4:]] = v
+                elif not (k.startswith('pms_') and ('apx_' + k[4:]) in data):
+                    attributes[k] = v
+            lw_id = attributes.pop('lw_id')
 
             return cls(lw_id, attributes)
         except (KeyError, AttributeError):
@@ -110,24 +172,23 @@ class Security:
     def is_sec_type(self, sec_type):
         """ Determine whether this Security is of provided sec type """
 
-        # Convert to list
-        if sec_type == 'bond':
-            sec_types = ['cb', 'cf', 'cm', 'cv', 'fr', 'lb', 'ln', 'sf', 'tb', 'vm']
-        elif sec_type == 'equity':
-            sec_types = ['cc', 'ce', 'cg', 'ch', 'ci', 'cj', 'ck', 'cn', 'cr', 'cs', 'ct', 'cu', 'ps']
-        else:
-            sec_types = [sec_type]
+        # Get the set of sec type prefixes to compare against
+        sec_types = _SEC_TYPE_GROUPS.get(sec_type)
+        if sec_types is None:
+            sec_types = (sec_type,)
 
         # Get this Security's sec type and compare
         sec_sec_type = self.get_sec_type()
         if isinstance(sec_sec_type, str):
-            return self.get_sec_type()[:2] in sec_types
+            return sec_sec_type[:2] in sec_types
         else:
             return False
 
 
 @dataclass
 class PriceValue:
+    __slots__ = ('type_', 'value')
+
     type_: PriceType
     value: float
 
@@ -137,18 +198,19 @@ class PriceValue:
         if self.value is not None:
             # Replace np.nan and similar values with None.
             # This helps avoid issues when JSON (de)serializing "NaN"
-            # Commeted below line and added new line as part of the debug issue VerveSys
-            # if math.isnan(float(self.value)):
-            if self.value == "" or math.isnan(float(self.value)):
+            if self.value == "":
                 self.value = None
             else:
                 # The value may be of type Decimal, e.g. if originating from a sqlalchemy query.
                 # This can cause issues such as when JSON serializing. Convert to standard float to avoid such issues:
-                self.value = float(self.value)
+                value = float(self.value)
+                self.value = None if value != value else value  # NaN is the only float not equal to itself
 
 
 @dataclass
 class Price:
+    __slots__ = ('security', 'source', 'data_date', 'modified_at', 'values')
+
     security: Security
     source: PriceSource
     data_date: datetime.date
@@ -158,22 +220,20 @@ class Price:
     def to_dict(self):
         """ Export an instance to dict format """
         res = {'lw_id': self.security.lw_id
-            , 'data_date': self.data_date.isoformat()
+            , 'data_date': date_isoformat(self.data_date)
             , 'source': self.source.name
             , 'modified_at': self.modified_at.isoformat()
                # , self.type_.name: self.value
                }
 
-        # Get values - separating as it's a bit involved:
-        values = {pv.type_.name: pv.value for pv in self.values}
-
-        # There may be "xyz_bid" values. If so, we also want to incldue those as "xyz" if "xyz" DNE.
+        # Add values. There may be "xyz_bid" values. If so, we also want to include those as "xyz" if "xyz" DNE.
+        # An explicit "xyz" value always wins, whether it comes before or after the "xyz_bid".
         # TODO: revisit whether this is necessary?
-        bid_items_dict = {k[:-4]: v for k, v in values.items() if k[-4:] == '_bid' and k[:-4] not in values}
-        values.update(bid_items_dict)
-
-        # Add values to dict and return
-        res.update(values)
+        for pv in self.values:
+            name = pv.type_.name
+            res[name] = pv.value
+            if name.endswith('_bid'):
+                res.setdefault(name[:-4], pv.value)
         return res
 
     @classmethod
@@ -181,26 +241,38 @@ class Price:
         """ Create an instance from dict """
         try:
             security = Security(data['lw_id'])
-            source = PriceSource(data['source'])
-            data_date = (datetime.date.fromisoformat(data['data_date'])
+            source = PriceSource.of(data['source'])
+            data_date = (_date_fromisoformat(data['data_date'])
                          if isinstance(data['data_date'], str) else data['data_date'])
-            modified_at = (datetime.datetime.fromisoformat(data['modified_at'])
+            modified_at = (_datetime_fromisoformat(data['modified_at'])
                            if isinstance(data['modified_at'], str) else data['modified_at'])
 
             # Caller should provide a "values" dict containing types with their values, e.g. price/yield/duration
             if 'values' in data:
-                values = [PriceValue(PriceType(k), v) for k, v in data['values'].items()]
+                values = [PriceValue(PriceType.of(k), v) for k, v in data['values'].items()]
             else:
                 # If not provided, fall back on any of the following fields which were provided
-                values = [PriceValue(PriceType(k), data[k]) for k in data
+                values = [PriceValue(PriceType.of(k), data[k]) for k in data
                           if k in ('price', 'yield', 'duration')]
             return cls(security, source, data_date, modified_at, values)
         except (KeyError, AttributeError) as e:
             raise InvalidDictError(e)  # To be caught by callers
 
+    @classmethod
+    def from_dict_batch(cls, records: List[dict]) -> List['Price']:
+        """ Create a list of instances from a list of dicts, excluding any nulls """
+        from_dict = cls.from_dict
+        return [px for px in map(from_dict, records) if px is not None]
+
+
+# Keys in a PriceAuditEntry "before"/"after" dict which are not Price Values. See Price.to_dict
+_AUDIT_NON_VALUE_KEYS = frozenset({'lw_id', 'data_date', 'source', 'modified_at', 'modified_by', 'asofuser', 'asofdate'})
+
 
 @dataclass
 class PriceAuditEntry:
+    __slots__ = ('data_date', 'security', 'reason', 'comment', 'before', 'after', 'modified_by', 'modified_at')
+
     data_date: datetime.date
     security: Security
     reason: str
@@ -211,17 +283,18 @@ class PriceAuditEntry:
     modified_at: datetime.datetime
 
     def to_dict(self):
+        modified_at = self.modified_at.isoformat()
         return {
-            "data_date": self.data_date.isoformat(),
+            "data_date": date_isoformat(self.data_date),
             "lw_id": self.security.lw_id,
             "reason": self.reason,
             "comment": self.comment,
             "before": self.before.to_dict(),
             "after": self.after.to_dict(),
             "modified_by": self.modified_by,
-            "modified_at": self.modified_at.isoformat(),
+            "modified_at": modified_at,
             "asofuser": self.modified_by,
-            "asofdate": self.modified_at.isoformat(),
+            "asofdate": modified_at,
         }
 
     @classmethod
@@ -229,36 +302,21 @@ class PriceAuditEntry:
         # TODO: validations on the data? e.g. one price per PriceType in each before & after?
         try:
             sec = Security(lw_id=data["lw_id"])
-            data_date = datetime.date.fromisoformat(data["data_date"])
+            data_date = _date_fromisoformat(data["data_date"])
             modified_by = data["modified_by"] if 'modified_by' in data else data["asofuser"]
-            modified_at = datetime.datetime.fromisoformat(
-                data["modified_at"] if 'modified_at' in data
-                else data["asofdate"]
-            )
+            modified_at = data["modified_at"] if 'modified_at' in data else data["asofdate"]
+            if isinstance(modified_at, str):
+                modified_at = _datetime_fromisoformat(modified_at)
 
             # Get price values - assumption is that "before" and "after" each contain a "source",
             # and all other items in that dict which are convertable to float represent Price Values
-            before_price_values = []
-            for k, v in data['before'].items():
-                try:
-                    _ = float(v)
-                    pv = PriceValue(PriceType(k), v)
-                    before_price_values.append(pv)
-                except (TypeError, ValueError):
-                    pass  # if not a float, it's not a Price Value                
-            after_price_values = []
-            for k, v in data['after'].items():
-                try:
-                    _ = float(v)
-                    pv = PriceValue(PriceType(k), v)
-                    after_price_values.append(pv)
-                except  (TypeError, ValueError):
-                    pass  # if not a float, it's not a Price Value
-                
+            before_price_values = cls._get_price_values(data['before'])
+            after_price_values = cls._get_price_values(data['after'])
+
             # Create prices for before & after
-            before_price = Price(security=sec, source=PriceSource(data['before']['source'])
+            before_price = Price(security=sec, source=PriceSource.of(data['before']['source'])
                                  , data_date=data_date, modified_at=modified_at, values=before_price_values)
-            after_price = Price(security=sec, source=PriceSource(data['after']['source'])
+            after_price = Price(security=sec, source=PriceSource.of(data['after']['source'])
                                 , data_date=data_date, modified_at=modified_at, values=after_price_values)
 
             # Create & return class instance
@@ -275,6 +333,26 @@ class PriceAuditEntry:
         except (KeyError, AttributeError) as e:
             raise InvalidDictError(e)  # To be caught by callers
 
+    @staticmethod
+    def _get_price_values(price_dict: dict) -> List[PriceValue]:
+        """ Get the PriceValues from a "before" or "after" dict, i.e. the items which are convertable to float """
+        price_values = []
+        for k, v in price_dict.items():
+            if k in _AUDIT_NON_VALUE_KEYS:
+                continue  # known not to be a Price Value, no need to attempt the float conversion
+            try:
+                _ = float(v)
+                price_values.append(PriceValue(PriceType.of(k), v))
+            except (TypeError, ValueError):
+                pass  # if not a float, it's not a Price Value
+        return price_values
+
+
+# Keys in a SecurityWithPrices dict which are not Security attributes. See SecurityWithPrices.to_dict
+_SWP_RESERVED_KEYS = frozenset({
+    'lw_id', 'data_date', 'prices', 'curr_bday_prices', 'prev_bday_price', 'audit_trail', 'chosen_price'
+})
+
 
 @dataclass
 class SecurityWithPrices:
@@ -286,26 +364,29 @@ class SecurityWithPrices:
     prev_bday_price: Union[Price, None] = None
     audit_trail: Union[List[PriceAuditEntry], None] = None
 
+    def _get_chosen_price_index(self):
+        """ Get the index of the chosen price within curr_bday_prices, or None if there are none """
+        prices = self.curr_bday_prices
+        if not prices:
+            return None  # No prices, therefore there is no chosen one
+        # Highest in the hierarchy has the lowest rank. Ties go to the first price, as min() keeps the first minimum.
+        return min(range(len(prices)), key=lambda i: _price_rank(prices[i]))
+
     def get_chosen_price(self):
         """ Get the chosen price, based on the curr_bday_prices """
-        chosen_price = None
-        if self.curr_bday_prices is None:
-            return None  # No prices, therefore there is no chosen one
-        for px in self.curr_bday_prices:
-            if chosen_price is None:
-                chosen_price = px
-            elif px.source > chosen_price.source:  # See PriceSource __gt__ method
-                chosen_price = px
-        return chosen_price
+        chosen_idx = self._get_chosen_price_index()
+        return None if chosen_idx is None else self.curr_bday_prices[chosen_idx]
 
     def to_dict(self):
         """ Export an instance to dict format """
         res = self.security.to_dict()
-        res['data_date'] = self.data_date.isoformat()
-        res['curr_bday_prices'] = [] if self.curr_bday_prices is None else [px.to_dict() for px in
-                                                                            self.curr_bday_prices]
-        chosen_price = self.get_chosen_price()
-        res['chosen_price'] = {} if chosen_price is None else chosen_price.to_dict()
+        res['data_date'] = date_isoformat(self.data_date)
+        curr_bday_prices = self.curr_bday_prices or []
+        res['curr_bday_prices'] = [px.to_dict() for px in curr_bday_prices]
+        # The chosen price is one of the curr_bday_prices (see get_chosen_price), so reuse its dict rather than
+        # exporting it again. Copy it though, so callers can modify one without affecting the other.
+        chosen_idx = self._get_chosen_price_index()
+        res['chosen_price'] = {} if chosen_idx is None else dict(res['curr_bday_prices'][chosen_idx])
         res['prev_bday_price'] = {} if self.prev_bday_price is None else self.prev_bday_price.to_dict()
         res['audit_trail'] = [] if self.audit_trail is None else [at.to_dict() for at in self.audit_trail]
         return res
@@ -314,39 +395,32 @@ class SecurityWithPrices:
     def from_dict(cls, data: dict):
         """ Create an instance from dict """
         try:
-            security_attributes = {k: v for k, v in data.items()
-                                   if k not in (
-                                   'lw_id', 'data_date', 'prices', 'curr_bday_prices', 'prev_bday_price', 'audit_trail',
-                                   'chosen_price')}
-            security = Security(data['lw_id'], security_attributes)
-            data_date = datetime.date.fromisoformat(data['data_date'])
-            curr_bday_prices = None if 'curr_bday_prices' not in data else [
-                Price.from_dict(px_data) for px_data in data['curr_bday_prices']]
-            prev_bday_price = None
-            if 'prev_bday_price' in data:
-                if data['prev_bday_price'] != {}:
-                    prev_bday_price = Price.from_dict(data['prev_bday_price'])
-            audit_trail = None
-            if 'audit_trail' in data:
-                if data['audit_trail'] is not None and data['audit_trail'] != []:
-                    audit_trail = [PriceAuditEntry.from_dict(at_data) for at_data in data['audit_trail']]
-
-            # Remove any null prices and/or audit trail
-            if curr_bday_prices is not None:
-                curr_bday_prices = [px for px in curr_bday_prices if px is not None]
-            if audit_trail is not None:
-                audit_trail = [at for at in audit_trail if at is not None]
-
-            if None in (security, data_date):
-                return None  # If not all required attributes are provided, cannot create the instance
-            return cls(security, data_date, curr_bday_prices, prev_bday_price, audit_trail)
+            lw_id = data['lw_id']
+            data_date = _date_fromisoformat(data['data_date'])
+            security_attributes = {k: v for k, v in data.items() if k not in _SWP_RESERVED_KEYS}
         except (KeyError, AttributeError) as e:
             # If not all required attributes are provided, cannot create the instance
             raise InvalidDictError(e)  # To be caught by callers
+        security = Security(lw_id, security_attributes)
+
+        # Prices and audit trail are optional. Note null prices are already excluded by Price.from_dict_batch.
+        curr_bday_prices = data.get('curr_bday_prices')
+        if curr_bday_prices is not None:
+            curr_bday_prices = Price.from_dict_batch(curr_bday_prices)
+        prev_bday_price = data.get('prev_bday_price')
+        prev_bday_price = Price.from_dict(prev_bday_price) if prev_bday_price else None
+        audit_trail = data.get('audit_trail')
+        if audit_trail:
+            audit_trail = [at for at in map(PriceAuditEntry.from_dict, audit_trail) if at is not None]
+        else:
+            audit_trail = None
+        return cls(security, data_date, curr_bday_prices, prev_bday_price, audit_trail)
 
 
 @dataclass
 class PriceBatch:
+    __slots__ = ('source', 'data_date')
+
     source: PriceSource
     data_date: datetime.date
 
@@ -354,22 +428,24 @@ class PriceBatch:
         """ Export an instance to dict format """
         return {
             'source': self.source.name
-            , 'data_date': self.data_date.isoformat()
+            , 'data_date': date_isoformat(self.data_date)
         }
 
     @classmethod
     def from_dict(cls, data: dict):
         """ Create an instance from dict """
         try:
-            data_date = (datetime.date.fromisoformat(data['data_date'])
+            data_date = (_date_fromisoformat(data['data_date'])
                          if isinstance(data['data_date'], str) else data['data_date'])
-            return cls(PriceSource(data['source']), data_date)
+            return cls(PriceSource.of(data['source']), data_date)
         except (KeyError, AttributeError) as e:
             raise InvalidDictError(e)  # To be caught by callers
 
 
 @dataclass
 class AppraisalBatch:
+    __slots__ = ('portfolios', 'data_date')
+
     portfolios: str
     data_date: datetime.date
 
@@ -392,10 +468,18 @@ class Position:
     # prices: List[Price]  # TODO: is this needed? If so, only allow one price per price type?
 
 
-@dataclass
+@dataclass(eq=False)
 class PriceFeed:
+    __slots__ = ('name',)
+
     name: str
 
+    def __eq__(self, other):
+        return type(other) is type(self) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
 
 @dataclass
 class PriceFeedWithStatus:
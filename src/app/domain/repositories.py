@@ -4,6 +4,9 @@ from abc import ABC, abstractmethod
 import datetime
 from typing import List, Optional, Union
 
+# pypi
+import numpy as np
+
 # native
 from app.domain.models import (
     Price, PriceBatch, Security, PriceAuditEntry, SecurityWithPrices,
@@ -70,7 +73,9 @@ class SecuritiesWithPricesRepository(ABC):
         pass
 
     @abstractmethod
-    def refresh_for_securities(self, data_date: datetime.date, securities: List[Security]):
+    def refresh_for_securities(self, data_date: datetime.date, securities: Union[List[Security], np.ndarray]):
+        """ Refresh for the provided securities. For bulk refreshes, prefer providing a 1-D array of lw_ids
+        over a list of Securities, to avoid building Security instances only to have their lw_id extracted. """
         pass
 
     @abstractmethod
@@ -1,14 +1,19 @@
 
 # core python
+import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
 import os
 import requests
 import socket
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 # pypi
-import pandas as pd
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sqlalchemy import exc, update, and_
 
 # native
@@ -20,6 +25,41 @@ from app.infrastructure.util.config import AppConfig
 from app.infrastructure.util.file import prepare_dated_file_path
 
 
+# Shared session, so that IMEX requests re-use pooled connections rather than connecting each time.
+# Retry when the IMEX API is briefly unavailable, i.e. on failing to connect or a 502/503. 
+# Not on read timeouts/errors or 504 though: these POSTs run imports, and IMEX may have run regardless.
+# A 502/503 which persists is returned rather than raised, for callers to handle as any other failed response.
+_RETRY = Retry(total=3, connect=3, read=0, other=0, status=3, backoff_factor=0.5
+                , status_forcelist=[502, 503], allowed_methods=['GET', 'POST'], raise_on_status=False)
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=_RETRY))
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=_RETRY))
+_IMEX_TIMEOUT = (5, 300)  # (connect, read) seconds
+
+
+# APX price type ID and IMEX file suffix, by PriceType name
+_APX_PRICE_TYPE_ATTRIBUTES = {
+    'price'     : (1, ''),                  # Standard Prices
+    'yield'     : (2, '_LWBondYield'),      # LW Bond Yield
+    'duration'  : (3, '_LWBondDur'),        # LW Bond Duration
+}
+
+# APX price source ID, by PriceSource name
+_APX_PRICE_SOURCE_IDS = {
+    'FTSE'                  : 3006,  # LW FTSE TMX
+    'FTSETMX_PX'            : 3006,  # LW FTSE TMX
+    'BLOOMBERG'             : 3004,  # LW Bloomberg
+    'MARKIT'                : 3005,  # LW Markit
+    'MARKIT_LOAN'           : 3011,  # LW Markit Loan
+    'FUNDRUN'               : 3019,  # LW Fundrun Equity
+    'FIDESK_MANUALPRICE'    : 3007,  # LW FI Desk - Manual Price
+    'FIDESK_MISSINGPRICE'   : 3008,  # LW FI Desk - Missing Price
+    'MISSING'               : 3008,  # LW FI Desk - Missing Price
+    'MANUAL'                : 3032,  # LW Security Pricing - Manual
+    'OVERRIDE'              : 3033,  # LW Security Pricing - Override
+}
+_APX_DEFAULT_PRICE_SOURCE_ID = 3000  # LW Not Classified
+
 
 class APXPriceType(PriceType):
     """ Subclass of PriceType to add additional APX-specific attributes """
@@ -28,16 +68,9 @@ class APXPriceType(PriceType):
         super().__init__(price_type.name)
 
         # Populate additional APX-specific attributes below
-        if self.name == 'price':
-            self.price_type_id = 1  # Standard Prices
-            self.imex_file_suffix = ''
-        elif self.name == 'yield':
-            self.price_type_id = 2  # LW Bond Yield
-            self.imex_file_suffix = '_LWBondYield'
-        elif self.name == 'duration':
-            self.price_type_id = 3  # LW Bond Duration
-            self.imex_file_suffix = '_LWBondDur'
-        else:
+        try:
+            self.price_type_id, self.imex_file_suffix = _APX_PRICE_TYPE_ATTRIBUTES[self.name]
+        except KeyError:
             raise NotImplementedError(f"Cannot create APXPriceType with name {self.name}")
 
     def __hash__(self):
@@ -51,62 +84,89 @@ class APXPriceSource(PriceSource):
         super().__init__(price_source.name)
 
         # Populate additional APX-specific attributes below
-        if self.name in ('FTSE', 'FTSETMX_PX'):
-            self.price_source_id = 3006  # LW FTSE TMX
-        elif self.name == 'BLOOMBERG':
-            self.price_source_id = 3004  # LW Bloomberg
-        elif self.name == 'MARKIT':
-            self.price_source_id = 3005  # LW Markit
-        elif self.name == 'MARKIT_LOAN':
-            self.price_source_id = 3011  # LW Markit Loan
-        elif self.name == 'FUNDRUN':
-            self.price_source_id = 3019  # LW Fundrun Equity
-        elif self.name == 'FIDESK_MANUALPRICE':
-            self.price_source_id = 3007  # LW FI Desk - Manual Price
-        elif self.name == 'FIDESK_MISSINGPRICE':
-            self.price_source_id = 3008  # LW FI Desk - Missing Price
-        elif self.name == 'MISSING':
-            self.price_source_id = 3008  # LW FI Desk - Missing Price
-        elif self.name == 'MANUAL':
-            self.price_source_id = 3032  # LW Security Pricing - Manual
-        elif self.name == 'OVERRIDE':
-            self.price_source_id = 3033  # LW Security Pricing - Override
-        else:
-            self.price_source_id = 3000  # LW Not Classified
+        self.price_source_id = _APX_PRICE_SOURCE_IDS.get(self.name, _APX_DEFAULT_PRICE_SOURCE_ID)
 
 
 class IMEXError(Exception):
     pass
 
 
+class _IMEXBucket:
+    """ Column-wise rows for one IMEX file, i.e. for one price date & type """
+
+    def __init__(self, size: int):
+        # Columns are allocated up front for the known number of rows, then filled in by append
+        self.sec_types = [None] * size
+        self.symbols = [None] * size
+        self.values = array.array('d', [0.0]) * size  # missing values are stored as NaN
+        self.messages = [''] * size
+        self.sources = [0] * size
+        self._next = 0
+
+    def append(self, px: Price, pv: PriceValue):
+        i = self._next
+        self.sec_types[i] = px.security.attributes['pms_sec_type']
+        self.symbols[i] = px.security.attributes['pms_symbol']
+        self.values[i] = float('nan') if pv.value is None else pv.value
+        self.sources[i] = _APX_PRICE_SOURCE_IDS.get(px.source.name, _APX_DEFAULT_PRICE_SOURCE_ID)
+        self._next = i + 1
+
+    def to_lines(self) -> List[str]:
+        """ Tab-separated lines in IMEX format, with no header or index """
+        # Values are written as repr, i.e. the shortest string which round-trips, as DataFrame.to_csv did.
+        # A fixed precision format would round prices, yields & durations. Missing (NaN) values are left empty.
+        value_strs = ['' if v != v else repr(v) for v in self.values.tolist()]
+        source_strs = np.char.mod('%d', np.asarray(self.sources, dtype=np.int64)).tolist()
+        return [
+            f"{sec_type}\t{symbol}\t{value}\t{message}\t{source}\n"
+            for sec_type, symbol, value, message, source 
+            in zip(self.sec_types, self.symbols, value_strs, self.messages, source_strs)
+        ]
+
+
 class APXPriceRepository(PriceRepository):
     # We'll retrieve security attributes from below repo
     security_repo = CoreDBSecurityRepository()
 
+    def __init__(self):
+        # IMEX configs, which are needed for each IMEX file
+        self.apx_server = AppConfig().parser.get('apx_imex', 'apx_server')
+        self.imex_base_url = AppConfig().parser.get('apx_imex', 'rest_api_base_url')
+        self.imex_batch_api = AppConfig().parser.getboolean('apx_imex', 'batch_api', fallback=False)
+        self.imex_max_concurrent_requests = AppConfig().parser.getint('apx_imex', 'max_concurrent_requests', fallback=4)
+
     def create(self, prices: Union[List[Price], Price]) -> int:
         if isinstance(prices, Price):
             # Need to convert to List in order to loop thru
             prices = [prices]
 
+        # Get configs
+        lw_price_source_names = frozenset(s.strip() for s in AppConfig().parser.get('app', 'lw_price_sources').split(','))
+        data_dir = AppConfig().parser.get('files', 'data_dir')
+        base_path = os.path.join(data_dir, 'lw', 'security_pricing', 'imex')
+        write_buffer_bytes = AppConfig().parser.getint('files', 'imex_write_buffer_bytes', fallback=4*1024*1024)
+
+        # Skip anything not from LW price sources.
+        # Rationale is: For vendor sources, they will have already been loaded into APX by the pre-existing loaders.
+        # And if there is no LW user pricing them, there is no audit trail requirement.
+        lw_prices = [px for px in prices if px.source.name in lw_price_source_names]
+
+        # Get Securities with attributes in one go. Need to do this because the Security as part of the price 
+        # likely only has an lw_id, and we need more attributes for IMEX.
+        secs = self.security_repo.get_many([px.security.lw_id for px in lw_prices])
+
+        # Count values per price date and type, so that each bucket below can be sized up front
+        bucket_sizes = Counter((px.data_date, pv.type_.name) for px in lw_prices for pv in px.values)
+
         # Loop thru and populate a dict by price date and type, since for IMEX we'll create one file per date & type.
         prices_by_date_and_type = {}
-        for px in prices:
-            # Skip anything not from LW price sources.
-            # Rationale is: For vendor sources, they will have already been loaded into APX by the pre-existing loaders.
-            # And if there is no LW user pricing them, there is no audit trail requirement.
-            lw_price_source_names = AppConfig().parser.get('app', 'lw_price_sources').split(',')
-            lw_price_source_names = [s.strip() for s in lw_price_source_names]
-            if px.source.name not in lw_price_source_names:
-                continue
-
+        apx_price_types = {}
+        for px in lw_prices:
             # Convert PriceTypes to APXPriceTypes. This will populate additional APX-specific attributes.
             # px.values = [PriceValue(APXPriceType(pv.type_), pv.value) for pv in px.values]
 
-            # Get Security with attributes, and replace the Security in the Price.
-            # Need to do this because the Security as part of the price likely only has an lw_id, 
-            # and we need more attributes for IMEX.
-            sec = self.security_repo.get(px.security.lw_id)[0]
-            px.security = sec
+            # Replace the Security in the Price with the one which has attributes
+            px.security = secs[px.security.lw_id]
 
             # Add date to top level, if it DNE
             if px.data_date not in prices_by_date_and_type:
@@ -115,27 +175,23 @@ class APXPriceRepository(PriceRepository):
             # Loop through values, and add them to the dict
             for price_value in px.values:
                 # Get APXPriceType. This will provide additional APX-specific attributes.
-                apx_price_type = APXPriceType(price_value.type_)
+                apx_price_type = apx_price_types.get(price_value.type_.name)
+                if apx_price_type is None:
+                    apx_price_type = apx_price_types[price_value.type_.name] = APXPriceType(price_value.type_)
 
-                # Create empty DataFrame under data_date and apx_price_type, if it DNE
+                # Create empty bucket under data_date and apx_price_type, if it DNE
                 if apx_price_type not in prices_by_date_and_type[px.data_date]:
-                    prices_by_date_and_type[px.data_date][apx_price_type] = pd.DataFrame(
-                            columns=['pms_sec_type','pms_symbol','value','message','source'])
+                    prices_by_date_and_type[px.data_date][apx_price_type] = _IMEXBucket(
+                        bucket_sizes[(px.data_date, price_value.type_.name)])
                     
-                # Get IMEX fields dict, then append to DataFrame
-                imex_fields_dict = self.get_imex_price_fields_dict(px, price_value)
-                prices_by_date_and_type[px.data_date][apx_price_type] = (
-                    pd.concat([prices_by_date_and_type[px.data_date][apx_price_type]
-                            , pd.DataFrame([imex_fields_dict])], ignore_index=True)
-                )
-
-        # Now we have a layered dict of DataFrames as follows: {
+                # Append IMEX fields to the bucket
+                prices_by_date_and_type[px.data_date][apx_price_type].append(px, price_value)
+
+        # Now we have a layered dict of buckets as follows: {
         #   from_date: {
-        #       apx_price_type: <DataFrame>
+        #       apx_price_type: <_IMEXBucket>
         #   }
         # }
-        data_dir = AppConfig().parser.get('files', 'data_dir')
-        base_path = os.path.join(data_dir, 'lw', 'security_pricing', 'imex')
         # Loop thru it and generate the files for IMEX.
         # Also append to a list of IMEX files as we go, so that we can then trigger IMEX fro each one
         imex_files = []
@@ -148,65 +204,98 @@ class APXPriceRepository(PriceRepository):
                 full_path = prepare_dated_file_path(folder_name=base_path, date=datetime.date.today()
                     , file_name=file_name, rotate=True)
 
-                # Write to file
-                df = prices_by_date_and_type[from_date][apx_price_type]
-                df.to_csv(path_or_buf=full_path, sep='\t', header=False, index=False)
+                # Write to file. IMEX files are tab-separated with no header or index, 
+                # so write the lines directly rather than going through pandas.
+                # The whole file content goes out in a single write, since data_dir is typically a network share.
+                bucket = prices_by_date_and_type[from_date][apx_price_type]
+                with open(full_path, 'w', buffering=write_buffer_bytes) as f:
+                    f.write(''.join(bucket.to_lines()))
                 imex_files.append(full_path)
 
         # Trigger IMEX
         imex_results = {}
-        for full_path in imex_files:
-            imex_response = self.trigger_imex_api(full_path)
+        for full_path, imex_response in self.trigger_imex_api_bulk(imex_files).items():
             if not imex_response.ok:
-                logging.error(f"{imex_response.json()['message']}")
-                logging.error(f"Log result from {imex_response.json()['data']['imex_log_file']}: \n\n{imex_response.json()['data']['imex_log_file_contents']}")
+                # The IMEX REST API responds with JSON, but a gateway in front of it (e.g. on a persistent 502/503) 
+                # may not. Parse the body once, and fall back on its text so that the IMEXError below still gets raised.
+                try:
+                    result = imex_response.json()
+                except ValueError:
+                    result = imex_response.text
+                try:
+                    logging.error(f"{result['message']}")
+                    logging.error(f"Log result from {result['data']['imex_log_file']}: \n\n{result['data']['imex_log_file_contents']}")
+                except (KeyError, TypeError):
+                    logging.error('IMEX request for %s failed with HTTP %s: %s', full_path, imex_response.status_code, result)
                 imex_results[full_path] = {
                     'http_status_code': imex_response.status_code,
-                    'result': imex_response.json()
+                    'result': result
                 }
-                raise IMEXError(f'An IMEX command failed!')
+        if len(imex_results):
+            raise IMEXError(f'IMEX failed for {", ".join(imex_results)}!')
 
         logging.info(f'APXPriceRepository returning {len(prices)}')
         return len(prices)  # return row count of the number successfully saved
         
     def trigger_imex(self, full_path, mode='Ama'):   
         # Get configs
-        prefix = AppConfig().parser.get('apx_imex', 'apx_server')
-        imex_base_url = AppConfig().parser.get('apx_imex', 'rest_api_base_url')
+        prefix = self.apx_server
+        imex_base_url = self.imex_base_url
 
         # Build commands
         # regedit_cmd = f"C:\\Windows\\regedit /s {prefix}\\APX$\\exe\\ServerURL.reg"  # TODO_CLEANUP: is this needed? The IMEXUtil.pm does it before calling IMEX
-        folder = os.path.dirname(full_path)     
         # TODO_CLEANUP: remove below? Not needed?
-        folder = folder.replace('R:', '\\\\dev-data\\lws$')
         full_path = full_path.replace('R:', '\\\\dev-data\\lws$')
+        folder = os.path.dirname(full_path)
         imex_cmd = f"\\\\{prefix}\\APX$\\exe\\ApxIX.exe IMEX -i \"-s{folder}\" -{mode} \"-f{full_path}\" -ttab4 -u"
         
         payload = {'cmd': imex_cmd}
         logging.info(f'Submitting request for IMEX cmd to {imex_base_url}/run-cmd: {imex_cmd}')
-        response = requests.post(f'{imex_base_url}/run-cmd', json=payload)
-        logging.info(f'IMEX POST response: {response}')
+        response = _SESSION.post(f'{imex_base_url}/run-cmd', json=payload, timeout=_IMEX_TIMEOUT)
+        logging.info('IMEX POST response: %s', response)
         return response
 
     def trigger_imex_api(self, full_path, mode='merge_and_append'): 
         # Get configs
-        imex_base_url = AppConfig().parser.get('apx_imex', 'rest_api_base_url')
+        imex_base_url = self.imex_base_url
 
         # Build payload and submit request to external IMEX REST API
         payload = {'full_path': full_path, 'mode': mode}
-        logging.info(f'Submitting {mode} request for IMEX cmd to {imex_base_url}/run-imex with IMEX file: {full_path}')
-        response = requests.post(f'{imex_base_url}/run-imex', json=payload)
-        logging.info(f'IMEX POST response: {response}')
+        logging.info('Submitting %s request for IMEX cmd to %s/run-imex with IMEX file: %s', mode, imex_base_url, full_path)
+        response = _SESSION.post(f'{imex_base_url}/run-imex', json=payload, timeout=_IMEX_TIMEOUT)
+        logging.info('IMEX POST response: %s', response)
         return response
 
-    def get_imex_price_fields_dict(self, px: Price, pv: PriceValue) -> dict:
-        return {
-            'pms_sec_type'  : px.security.attributes['pms_sec_type'],
-            'pms_symbol'    : px.security.attributes['pms_symbol'],
-            'value'         : pv.value,
-            'message'       : '',
-            'source'        : APXPriceSource(px.source).price_source_id,
-        }
+    def trigger_imex_api_bulk(self, full_paths: List[str], mode='merge_and_append') -> Dict[str, requests.Response]:
+        """
+        Trigger IMEX for multiple files
+
+        If enabled in config (apx_imex.batch_api), all files are submitted in one request to the IMEX REST API. 
+        Otherwise, or if the API does not support batches, each file is submitted in its own request. 
+        Each file is for a distinct date & type, so these are independent and submitted concurrently.
+
+        Args:
+        - full_paths (list of str): IMEX files to load.
+        - mode (str): IMEX mode.
+
+        Returns:
+        - dict: Response by the file(s) it is for.
+        """
+        if not len(full_paths):
+            return {}
+        if self.imex_batch_api:
+            imex_base_url = self.imex_base_url
+            payload = {'full_paths': full_paths, 'mode': mode}
+            logging.info('Submitting %s request for IMEX cmd to %s/run-imex-batch with %d IMEX files', mode, imex_base_url, len(full_paths))
+            response = _SESSION.post(f'{imex_base_url}/run-imex-batch', json=payload, timeout=_IMEX_TIMEOUT)
+            logging.info('IMEX POST response: %s', response)
+            if response.status_code not in (404, 405):
+                return {', '.join(full_paths): response}
+            logging.info('IMEX REST API does not support batches. Will submit IMEX files individually.')
+
+        with ThreadPoolExecutor(max_workers=self.imex_max_concurrent_requests) as executor:
+            responses = executor.map(lambda p: self.trigger_imex_api(p, mode=mode), full_paths)
+            return dict(zip(full_paths, responses))
 
     def get(self, data_date: datetime.date, source: Union[PriceSource,None]=None
             , security: Union[Security,None]=None) -> List[Price]:
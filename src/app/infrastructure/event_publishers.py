@@ -1,6 +1,7 @@
 
 # core python
 from abc import ABC, abstractmethod
+import atexit
 from dataclasses import dataclass
 import datetime
 import json
@@ -11,6 +12,10 @@ from typing import List, Optional, Tuple, Type, Union
 # PyPi
 from configparser import ConfigParser
 from confluent_kafka import Producer
+try:
+    import orjson
+except ImportError:  # optional; fall back on the standard json module
+    orjson = None
 
 # native
 from app.domain.events import (Event
@@ -24,12 +29,35 @@ from app.infrastructure.util.config import AppConfig
 from app.infrastructure.util.date import format_time
 
 
+_MODIFIED_BY = os.path.basename(__file__)
+
+# Producers which have not been closed yet, so that messages still queued by any of them get delivered on exit 
+# (see linger.ms). Strong references, so that a producer dropped without being closed still gets flushed.
+# Producers are only removed by close, so callers should close producers they are done with (see close).
+_PRODUCERS = set()
+
+
+@atexit.register
+def _flush_producers():
+    for p in list(_PRODUCERS):
+        p.close()
+
+
+def _json_dumps(obj) -> bytes:
+    """ Serialize to UTF-8 encoded JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
 class KafkaEventProducer(EventPublisher):
-    def __init__(self, topics: List[str]):
-        super().__init__(message_broker=KafkaBroker(), topics=topics)
-        self.config = dict(AppConfig().parser['kafka_broker'])
+    def __init__(self, topics: List[str], message_broker: Optional[KafkaBroker]=None):
+        super().__init__(message_broker=(message_broker or KafkaBroker.instance()), topics=topics)
+        self.config = dict(self.message_broker.config)
         self.config.update(AppConfig().parser['kafka_producer'])
         self.producer = Producer(self.config)
+        self._log_delivery = AppConfig().parser.getboolean('kafka_producer_lw', 'log_delivery', fallback=False)
+        _PRODUCERS.add(self)
     
     @abstractmethod
     def serialize(self, event: Type[Event]) -> Tuple[Optional[str], bytes]:  
@@ -38,17 +66,36 @@ class KafkaEventProducer(EventPublisher):
     
     def callback(self, err, msg):
         if err:
-            logging.error('ERROR: Message failed delivery: {}'.format(err))
-        else:
-            logging.info("Produced event to topic {topic}: key = {key:12} value = {value:12}".format(
-                topic=msg.topic(), key=msg.key().decode('utf-8'), value=msg.value().decode('utf-8')))
-
-    def publish(self, event: Event, flush=True):
+            logging.error('ERROR: Message failed delivery: %s', err)
+        elif self._log_delivery and logging.getLogger().isEnabledFor(logging.INFO):
+            # Only decode the message when it will actually be logged
+            logging.info("Produced event to topic %s: key = %-12s value = %-12s"
+                , msg.topic(), msg.key().decode('utf-8'), msg.value().decode('utf-8'))
+
+    def publish(self, event: Event, flush=False):
+        """ Publish the event to each of self.topics. The event is serialized once, regardless of the number of topics. """
         key, value = self.serialize(event)
-        for topic in self.topics:
-            self.producer.produce(topic, key=key, value=value, on_delivery=self.callback)
-            if flush:
-                self.producer.flush()
+        produce, callback = self.producer.produce, self.callback
+        for t in self.topics:
+            produce(t, key=key, value=value, on_delivery=callback)
+        # Serve delivery callbacks for earlier messages without blocking
+        self.producer.poll(0)
+        if flush:
+            self.producer.flush()
+
+    def close(self):
+        """ 
+        Deliver any queued messages. Callers must call this (or use the producer as a context manager) 
+        once done publishing. Any producer not closed is kept alive until exit, and then closed.
+        """
+        self.producer.flush()
+        _PRODUCERS.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 class KafkaCoreDBPortfolioCreatedEventProducer(KafkaEventProducer):
@@ -85,6 +132,8 @@ class KafkaCoreDBPortfolioCreatedEventProducer(KafkaEventProducer):
                 },
             ]
         }
+        # The schema never changes, so serialize the start of the message envelope once
+        self._schema_prefix = b'{"schema":' + _json_dumps(self.schema) + b',"payload":'
     
     def serialize(self, event: PortfolioCreatedEvent) -> Tuple[Optional[str], bytes]:
         
@@ -95,17 +144,13 @@ class KafkaCoreDBPortfolioCreatedEventProducer(KafkaEventProducer):
             'portfolio_code'	: portfolio.portfolio_code,
             'portfolio_type'	: portfolio.attributes['portfolio_type'],
             'modified_at'		: format_time(datetime.datetime.now()),
-            'modified_by'		: os.path.basename(__file__)
+            'modified_by'		: _MODIFIED_BY
         }
 
         # Return key and value
         key = str(coredb_portfolio_dict['portfolio_code'])
-        value_dict = {
-            "schema": self.schema,
-            "payload": coredb_portfolio_dict
-        }
-        value = json.dumps(value_dict).encode('utf-8')
-        logging.debug(f'Derived key and value portfolio: {portfolio}\n{key}\n{value}')
+        value = self._schema_prefix + _json_dumps(coredb_portfolio_dict) + b'}'
+        logging.debug('Derived key and value portfolio: %s\n%s\n%s', portfolio, key, value)
         return (key, value)
 
 
@@ -154,6 +199,8 @@ class KafkaCoreDBPositionEventProducer(KafkaEventProducer):
                 },
             ]
         }
+        # Pre-serialized envelope prefix, as for portfolios
+        self._schema_prefix = b'{"schema":' + _json_dumps(self.schema) + b',"payload":'
     
     def serialize(self, event: Union[PositionCreatedEvent, PositionDeletedEvent]
             ) -> Tuple[Optional[str], bytes]:
@@ -167,18 +214,14 @@ class KafkaCoreDBPositionEventProducer(KafkaEventProducer):
             'is_short'			: position.is_short,
             'quantity'			: position.quantity,
             'modified_at'		: format_time(datetime.datetime.now()),
-            'modified_by'		: os.path.basename(__file__),
+            'modified_by'		: _MODIFIED_BY,
             'is_deleted'        : True if isinstance(event, PositionDeletedEvent) else False
         }
 
         # Return key and value
         key = str(coredb_position_dict['pms_position_id'])
-        value_dict = {
-            "schema": self.schema,
-            "payload": coredb_position_dict
-        }
-        value = json.dumps(value_dict).encode('utf-8')
-        logging.debug(f'Derived key and value position: {position}\n{key}\n{value}')
+        value = self._schema_prefix + _json_dumps(coredb_position_dict) + b'}'
+        logging.debug('Derived key and value position: %s\n%s\n%s', position, key, value)
         return (key, value)
 
 
@@ -1,28 +1,36 @@
 
 # core python
 from abc import abstractmethod
-from dataclasses import dataclass
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
 import json
 import logging
+import threading
 import time
-from typing import List, Type, Union
+from typing import List, Optional, Union
 
 
 # pypi
-from confluent_kafka import Consumer, OFFSET_BEGINNING, OFFSET_END
+from confluent_kafka import Consumer, OFFSET_BEGINNING
+try:
+    import orjson
+except ImportError:  # optional; fall back on the standard json module
+    orjson = None
+try:
+    import simdjson
+except ImportError:  # optional; CDC messages are then parsed in full
+    simdjson = None
 
 # native
+from app.application.event_handlers import PortfolioCreatedEventHandler
 from app.domain.events import (
     Event, AppraisalBatchCreatedEvent, PriceBatchCreatedEvent, SecurityCreatedEvent,
     PositionCreatedEvent, PositionDeletedEvent, PortfolioCreatedEvent
 )
 from app.domain.event_handlers import EventHandler
 from app.domain.event_subscribers import EventSubscriber
-from app.domain.exceptions import (
-    SecurityNotFoundException, PortfolioNotFoundException
-)
-from app.domain.message_brokers import MessageBroker
 from app.domain.models import (
     Security, AppraisalBatch, PriceBatch, PriceSource
     , Position, Portfolio
@@ -30,24 +38,61 @@ from app.domain.models import (
 from app.domain.repositories import PortfolioRepository
 
 from app.infrastructure.message_brokers import KafkaBroker
-from app.infrastructure.sql_repositories import (
-    CoreDBPortfolioRepository, CoreDBSecurityRepository
-)
 from app.infrastructure.util.config import AppConfig
 
 
+# Both accept the raw bytes of a Kafka message value, so there is no need to decode first
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+# Dates in coredb messages are in days since epoch
+_EPOCH_DATE = datetime.date(1970, 1, 1)
+
+# Event handlers which are safe to run on more than one thread at once (see KafkaEventConsumer.consume).
+# Only add a handler here if it does not read-modify-write anything shared between message keys, 
+# e.g. the read model files. PortfolioCreatedEventHandler only upserts the portfolio's own row in the DB.
+_CONCURRENT_SAFE_HANDLERS = (PortfolioCreatedEventHandler,)
+
+
+@functools.lru_cache(maxsize=None)
+def _topic(key: str) -> str:
+    return AppConfig().parser.get('kafka_topics', key)
+
+
+@functools.lru_cache(maxsize=1024)
+def _epoch_ms_isoformat(epoch_ms: int) -> str:
+    """ Local time ISO format for a timestamp in milliseconds since epoch. Cached, since replays repeat timestamps. """
+    return datetime.datetime.fromtimestamp(epoch_ms / 1000.0).isoformat()
+
+
+def _get_field(row, name: str):
+    """ 
+    Get a field from a CDC row by its lowercase name, regardless of the case used by the source table.
+    Works on dicts and on lazily parsed simdjson objects, without converting the whole row.
+    """
+    if name in row:
+        return row[name]
+    for k in row.keys():
+        if k.lower() == name:
+            return row[k]
+    raise KeyError(name)
+
 
 class DeserializationError(Exception):
     pass
 
 
 class KafkaEventConsumer(EventSubscriber):
-    def __init__(self, topics, event_handler):
-        super().__init__(message_broker=KafkaBroker(), topics=topics, event_handler=event_handler)
-        self.config = dict(self.message_broker.config)
-        self.config.update(AppConfig().parser['kafka_consumer'])
+    def __init__(self, topics, event_handler, message_broker: Optional[KafkaBroker]=None):
+        super().__init__(message_broker=(message_broker or KafkaBroker.instance()), topics=topics, event_handler=event_handler)
+        self.config = {**self.message_broker.config, **AppConfig().as_dict['kafka_consumer']}
+        # Offsets are stored explicitly once a message has been handled (see consume), then committed per batch
+        self.config['enable.auto.offset.store'] = False
         logging.info(f'Creating KafkaEventConsumer with config: {type(self.config)} {self.config}')
         self.consumer = Consumer(self.config)
+        self._closed = False
+        self._stop_event = threading.Event()
+        self._sleep_secs = int(AppConfig().parser.get('kafka_consumer_lw', 'sleep_seconds', fallback=0))
+        self._cdc_parser = threading.local()  # simdjson parsers must not be shared between threads
         # self.consumer.subscribe(self.topics, on_assign=self.on_assign)
         # TODO: remove above when not needed
     
@@ -72,61 +117,152 @@ class KafkaEventConsumer(EventSubscriber):
     #         # Leave group and commit final offsets
     #         self.consumer.close()
 
-    def consume(self, reset_offset: bool=False, async_commit=False):
+    def consume(self, reset_offset: bool=False, async_commit=False, batch_size: Optional[int]=None
+            , poll_timeout: Optional[float]=None, handler_workers: Optional[int]=None):
+        """
+        Consume messages from self.topics and handle them, until interrupted or stopped (see stop)
+
+        Args:
+        - reset_offset (bool): Whether to start from the beginning of the topics.
+        - async_commit (bool): Whether to commit offsets asynchronously.
+        - batch_size (int): Max messages to fetch at once. Offsets are committed once per batch.
+            Defaults to kafka_consumer_lw.batch_size in config, or 500.
+        - poll_timeout (float): Max seconds to wait for messages per fetch. A lower timeout means more wake-ups 
+            (and CPU) when idle, but a partial batch gets handled sooner. Defaults to 1.5x the consumer's 
+            fetch.wait.max.ms (500ms if not configured), so that a fetch normally completes within one wait.
+        - handler_workers (int): Number of threads to handle each batch's messages with. Messages are sharded 
+            by key, so messages with the same key are still handled in order. Only honoured for the event handlers 
+            in _CONCURRENT_SAFE_HANDLERS; other handlers always run on 1 thread. 
+            Defaults to kafka_consumer_lw.handler_workers in config, or 1.
+        """
         self.reset_offset = reset_offset
         self.consumer.subscribe(self.topics, on_assign=self.on_assign)
+        handler_pool = None
         try:
-            sleep_secs = int(AppConfig().parser.get('kafka_consumer_lw', 'sleep_seconds', fallback=0))
-            while True:
-                msg = self.consumer.poll(1.0)
-                if msg is None:
+            if batch_size is None:
+                batch_size = int(AppConfig().parser.get('kafka_consumer_lw', 'batch_size', fallback=500))
+            if poll_timeout is None:
+                poll_timeout = 1.5 * int(self.config.get('fetch.wait.max.ms', 500)) / 1000.0
+            if handler_workers is None:
+                handler_workers = int(AppConfig().parser.get('kafka_consumer_lw', 'handler_workers', fallback=1))
+            if handler_workers > 1 and not isinstance(self.event_handler, _CONCURRENT_SAFE_HANDLERS):
+                logging.warning('%s is not safe to run concurrently. Ignoring handler_workers=%s and handling on 1 thread.'
+                    , type(self.event_handler).__name__, handler_workers)
+                handler_workers = 1
+            if handler_workers > 1:
+                handler_pool = ThreadPoolExecutor(max_workers=handler_workers, thread_name_prefix='kafka-handler')
+
+            # Bind the per-message callables once, rather than re-resolving them on every message
+            consume_batch = self.consumer.consume
+            store_offsets = self.consumer.store_offsets
+            commit = self.consumer.commit
+            process_messages = self.process_messages
+
+            while not self._stop_event.is_set():
+                msgs = consume_batch(num_messages=batch_size, timeout=poll_timeout)
+                if not msgs:
                     # Initial message consumption may take up to
                     # `session.timeout.ms` for the consumer group to
                     # rebalance and start consuming
                     logging.debug("Waiting...")
-                elif msg.error():
-                    logging.error(f"ERROR: {msg.error()}")
-                    # TODO: raise exception?
-                elif msg.value() is not None:
-                    logging.info(f"Consuming message: {msg.value()}")
-                    should_commit = True  # commit at the end, unless this gets overridden below
-                    try:
-                        event = self.deserialize(msg.value())
-
-                        if event is None:
-                            # A deserialize method returning None means the kafka message
-                            # does not meet criteria for representing an Event that needs handling.
-                            # Therefore if reaching here we should simply commit offset.
-                            self.consumer.commit(message=msg, asynchronous=async_commit)
-                            continue
-                        
-                        # If reaching here, we have an Event that should be handled:
-                        logging.info(f"Handling {event}")
-                        should_commit = self.event_handler.handle(event)
-                        logging.info(f"Done handling {event}")
-                    
-                    except Exception as e:
-                        if isinstance(e, DeserializationError):
-                            logging.exception(f'Exception while deserializing: {e}')
-                            should_commit = self.event_handler.handle_deserialization_error(e)
-                        else:
-                            logging.exception(e)  # TODO: any more valuable logging?
-                    
-                    # Commit, unless we should not based on above results
+                    continue
+
+                valid_msgs = []
+                for msg in msgs:
+                    if msg.error():
+                        logging.error("ERROR: %s", msg.error())
+                        # TODO: raise exception?
+                    elif msg.value() is not None:
+                        valid_msgs.append(msg)
+
+                # Handle messages, getting whether each one's offset should be committed
+                if handler_pool is None:
+                    should_commits = process_messages(valid_msgs)
+                else:
+                    shards = defaultdict(list)
+                    for i, msg in enumerate(valid_msgs):
+                        shards[hash(msg.key()) % handler_workers].append(i)
+                    should_commits = [False] * len(valid_msgs)
+                    futures = {
+                        handler_pool.submit(process_messages, [valid_msgs[i] for i in idxs]): idxs 
+                        for idxs in shards.values()
+                    }
+                    for future, idxs in futures.items():
+                        for i, should_commit in zip(idxs, future.result()):
+                            should_commits[i] = should_commit
+
+                # Store offsets in message order, then commit them once for the batch
+                any_stored = False
+                for msg, should_commit in zip(valid_msgs, should_commits):
                     if should_commit:
-                        self.consumer.commit(message=msg, asynchronous=async_commit)
-                        logging.info("Done committing offset")
-                    else:
-                        logging.info("Not committing offset, likely due to the most recent exception")
-                    if sleep_secs:
-                        logging.info(f'Sleeping for {sleep_secs} seconds...')
-                        time.sleep(sleep_secs)
+                        store_offsets(message=msg)
+                        any_stored = True
+                if any_stored:
+                    commit(asynchronous=async_commit)
+                    logging.info("Done committing offsets")
         except KeyboardInterrupt:
             pass
         finally:
+            if handler_pool is not None:
+                handler_pool.shutdown(wait=True)
             # Leave group and commit final offsets
+            self.close()
+
+    def process_messages(self, msgs: list) -> List[bool]:
+        """ Deserialize and handle messages in order. Returns whether the offset of each message should be committed. """
+        sleep_secs = self._sleep_secs
+        deserialize = self.deserialize
+        handle = self.event_handler.handle
+        res = []
+        for msg in msgs:
+            value = msg.value()
+            logging.info("Consuming message: %s", value)
+            should_commit = True  # commit at the end, unless this gets overridden below
+            try:
+                event = deserialize(value)
+
+                # A deserialize method returning None means the kafka message
+                # does not meet criteria for representing an Event that needs handling.
+                # Therefore if reaching here we should simply commit offset.
+                if event is not None:
+                    # If reaching here, we have an Event that should be handled:
+                    logging.info("Handling %s", event)
+                    should_commit = handle(event)
+                    logging.info("Done handling %s", event)
+            
+            except Exception as e:
+                if isinstance(e, DeserializationError):
+                    logging.exception('Exception while deserializing: %s', e)
+                    should_commit = self.event_handler.handle_deserialization_error(e)
+                else:
+                    logging.exception(e)  # TODO: any more valuable logging?
+            
+            if not should_commit:
+                logging.info("Not committing offset, likely due to the most recent exception")
+            res.append(bool(should_commit))
+            if sleep_secs:
+                logging.info('Sleeping for %s seconds...', sleep_secs)
+                time.sleep(sleep_secs)
+        return res
+
+    def stop(self):
+        """ 
+        Ask consume to return once the batch in progress has been handled and committed. 
+        Safe to call from another thread; consume notices within one poll_timeout.
+        """
+        self._stop_event.set()
+
+    def close(self):
+        """ Close the underlying Consumer. Safe to call more than once. """
+        if not self._closed:
+            self._closed = True
             self.consumer.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def on_assign(self, consumer, partitions):
         # TODO: confirm this works as class method
@@ -151,6 +287,19 @@ class KafkaEventConsumer(EventSubscriber):
     #             # Extract the (optional) key and value, transform, and produce to coredb topic.
     #             return self.deserialize(msg.value())
 
+    def get_cdc_payload(self, message_value: bytes):
+        """ 
+        Get the payload of a CDC (Debezium) message. With simdjson available this is parsed lazily, 
+        so that only the fields actually accessed get converted to Python objects. 
+        The result is only valid until the next message is parsed.
+        """
+        if simdjson is not None:
+            parser = getattr(self._cdc_parser, 'parser', None)
+            if parser is None:
+                parser = self._cdc_parser.parser = simdjson.Parser()
+            return parser.parse(message_value)['payload']
+        return _json_loads(message_value)['payload']
+
     @abstractmethod
     def deserialize(self, message_value: bytes) -> Union[Event, None]:  # TODO: does the message always have to be bytes?
         """ 
@@ -159,54 +308,50 @@ class KafkaEventConsumer(EventSubscriber):
         This makes sense when the consumer is looking for specific criteria to represent 
         the desired Event, but that criteria is not necessarily met in every message from the topic(s).
         """
-        
-    def __del__(self):
-        self.consumer.close()
 
 
 class KafkaCoreDBSecurityCreatedEventConsumer(KafkaEventConsumer):
     def __init__(self, event_handler: EventHandler):
         """ Creates a KafkaEventConsumer to consume new/changed coredb securities with the provided event handler """
-        super().__init__(event_handler=event_handler, topics=[AppConfig().parser.get('kafka_topics', 'coredb_security')])
+        super().__init__(event_handler=event_handler, topics=[_topic('coredb_security')])
 
     def deserialize(self, message_value: bytes) -> SecurityCreatedEvent:
-        event_dict = json.loads(message_value.decode('utf-8'))
-        lw_id = event_dict['lw_id']
-        attributes = {k:event_dict[k] for k in event_dict if k != 'lw_id'}
+        attributes = _json_loads(message_value)
+        lw_id = attributes.pop('lw_id')
 
-        # Message could contain a modified_at, in seconds since epoch
-        if 'modified_at' in attributes:
-            if isinstance(attributes['modified_at'], int):
-                attributes['modified_at'] = datetime.datetime.fromtimestamp(attributes['modified_at'] / 1000.0)
-            attributes['modified_at'] = attributes['modified_at'].isoformat()
+        # Message could contain a modified_at, in milliseconds since epoch
+        modified_at = attributes.get('modified_at')
+        if isinstance(modified_at, int):
+            attributes['modified_at'] = _epoch_ms_isoformat(modified_at)
 
-        logging.debug(f'KafkaCoreDBSecurityCreatedEventConsumer lw_id: {lw_id} type {type(lw_id)}')
+        logging.debug('KafkaCoreDBSecurityCreatedEventConsumer lw_id: %s type %s', lw_id, type(lw_id))
         sec = Security(lw_id=lw_id, attributes=attributes)
-        logging.debug(f'KafkaCoreDBSecurityCreatedEventConsumer sec: {sec} type {type(sec)}')
+        logging.debug('KafkaCoreDBSecurityCreatedEventConsumer sec: %s type %s', sec, type(sec))
         event = SecurityCreatedEvent(sec)
-        logging.debug(f'KafkaCoreDBSecurityCreatedEventConsumer event: {event} type {type(event)}')
+        logging.debug('KafkaCoreDBSecurityCreatedEventConsumer event: %s type %s', event, type(event))
         return event
 
 
 class KafkaCoreDBAppraisalBatchCreatedEventConsumer(KafkaEventConsumer):
     def __init__(self, event_handler: EventHandler):
         """ Creates a KafkaEventConsumer to consume new/changed coredb appraisal batches with the provided event handler """
-        super().__init__(event_handler=event_handler, topics=[AppConfig().parser.get('kafka_topics', 'coredb_appraisal_batch')])
+        super().__init__(event_handler=event_handler, topics=[_topic('coredb_appraisal_batch')])
 
     def deserialize(self, message_value: bytes) -> AppraisalBatchCreatedEvent:
         # Get dict from Kafka message
-        event_dict = json.loads(message_value.decode('utf-8'))
-        event_dict = {k.lower(): v for k, v in event_dict.items()}
+        event_dict = _json_loads(message_value)
         
         # Populate default for portfolios ... note this should not be long-term
-        if 'portfolios' not in event_dict:
-            event_dict['portfolios'] = '@LW_OpenandMeasurementandTest'  # TODO: should this be an assumed default?
+        try:
+            portfolios = _get_field(event_dict, 'portfolios')
+        except KeyError:
+            portfolios = '@LW_OpenandMeasurementandTest'  # TODO: should this be an assumed default?
         
         # Convert "days since epoch" to date
-        date = (datetime.datetime(year=1970, month=1, day=1) + datetime.timedelta(days=event_dict['data_date'])).date()
+        date = _EPOCH_DATE + datetime.timedelta(days=_get_field(event_dict, 'data_date'))
 
         # Create batch, then event and return it
-        batch = AppraisalBatch(portfolios=event_dict['portfolios'], data_date=date)
+        batch = AppraisalBatch(portfolios=portfolios, data_date=date)
         event = AppraisalBatchCreatedEvent(batch)
         return event
 
@@ -214,30 +359,47 @@ class KafkaCoreDBAppraisalBatchCreatedEventConsumer(KafkaEventConsumer):
 class KafkaCoreDBPriceBatchCreatedEventConsumer(KafkaEventConsumer):
     def __init__(self, event_handler: EventHandler):
         """ Creates a KafkaEventConsumer to consume new/changed coredb price batches with the provided event handler """
-        super().__init__(event_handler=event_handler, topics=[AppConfig().parser.get('kafka_topics', 'coredb_price_batch')])
+        super().__init__(event_handler=event_handler, topics=[_topic('coredb_price_batch')])
 
     def deserialize(self, message_value: bytes) -> PriceBatchCreatedEvent:
-        event_dict = json.loads(message_value.decode('utf-8'))
-        event_dict = {k.lower(): v for k, v in event_dict.items()}
-        date = (datetime.datetime(year=1970, month=1, day=1) + datetime.timedelta(days=event_dict['data_date'])).date()
-        batch = PriceBatch(source=PriceSource(event_dict['source']), data_date=date)
+        event_dict = _json_loads(message_value)
+        date = _EPOCH_DATE + datetime.timedelta(days=_get_field(event_dict, 'data_date'))
+        batch = PriceBatch(source=PriceSource.of(_get_field(event_dict, 'source')), data_date=date)
         event = PriceBatchCreatedEvent(batch)
         return event
 
 
+# CDC operation -> (payload key of the row, Event class)
+_POSITION_OP_TABLE = {
+    'c': ('after', PositionCreatedEvent),   # create
+    'u': ('after', PositionCreatedEvent),   # update
+    'r': ('after', PositionCreatedEvent),   # read (snapshot)
+    'd': ('before', PositionDeletedEvent),  # delete
+}
+
+# Columns of an APX position CDC row to include in the Position attributes (lowercase)
+_POSITION_ATTRIBUTE_FIELDS = ('positionid', 'pms_position_id', 'portfolioid', 'securityid', 'quantity', 'isshortposition', 'ts_ms')
+
+
 class KafkaAPXPositionEventConsumer(KafkaEventConsumer):
     def __init__(self, event_handler: EventHandler):
         """ Creates a KafkaEventConsumer to consume new/deleted apxdb positions with the provided event handler """
-        super().__init__(event_handler=event_handler, topics=[AppConfig().parser.get('kafka_topics', 'apxdb_position')])
+        super().__init__(event_handler=event_handler, topics=[_topic('apxdb_position')])
 
     def deserialize(self, message_value: bytes) -> Union[PositionCreatedEvent, PositionDeletedEvent]:
-        event_dict = json.loads(message_value.decode('utf-8'))
+        payload = self.get_cdc_payload(message_value)
 
-        # Get vals. For a d (delete) this will be in payload->before, else payload->after.
-        if event_dict['payload']['op'] in ('d'):
-            vals = {k.lower():v for k, v in event_dict['payload']['before'].items()}
-        else:
-            vals = {k.lower():v for k, v in event_dict['payload']['after'].items()}
+        # Get vals and the event to create, based on the CDC operation. For a d (delete) vals will be in payload->before, else payload->after.
+        try:
+            row_key, event_class = _POSITION_OP_TABLE[payload['op']]
+        except KeyError:
+            # TODO: unrecognized operation exception?
+            return None
+        row = payload[row_key]
+
+        # Only take the columns which are used downstream, rather than converting the whole row
+        row_keys = {k.lower(): k for k in row.keys()}
+        vals = {name: row[row_keys[name]] for name in _POSITION_ATTRIBUTE_FIELDS if name in row_keys}
 
         # Create portfolio, note we should only need the pms_portfolio_id
         portfolio = Portfolio(portfolio_code='', attributes={'pms_portfolio_id': vals['portfolioid']})
@@ -245,14 +407,15 @@ class KafkaAPXPositionEventConsumer(KafkaEventConsumer):
         # Create security, note we should only need the pms_security_id
         security = Security(lw_id='', attributes={'pms_security_id': vals['securityid']})
 
-        # Include the pms_position_id in attributes, if it exists
-        position_attributes = vals.copy()
+        # Include the pms_position_id in attributes, if it exists. 
+        # vals is not used elsewhere, so it can become the attributes without a copy.
+        position_attributes = vals
         if 'positionid' in vals and 'pms_position_id' not in vals:
-            position_attributes.update({'pms_position_id':vals['positionid']})
+            position_attributes['pms_position_id'] = vals['positionid']
 
         # Temp20230912: include the ts_ms
         if 'ts_ms' not in position_attributes:
-            position_attributes.update({'ts_ms':event_dict['payload']['ts_ms']})
+            position_attributes['ts_ms'] = payload['ts_ms']
 
         # Create Position instance
         position = Position(portfolio=portfolio, data_date=datetime.date.today()
@@ -260,40 +423,75 @@ class KafkaAPXPositionEventConsumer(KafkaEventConsumer):
             , attributes=position_attributes)
 
         # Create and return event, either a delete or create
-        if event_dict['payload']['op'] in ('c', 'u', 'r'):
-            return PositionCreatedEvent(position)
-        elif event_dict['payload']['op'] in ('d'):
-            return PositionDeletedEvent(position)
-        else:
-            # TODO: unrecognized operation exception?
-            return None 
+        return event_class(position)
 
 
 class KafkaAPXPortfolioEventConsumer(KafkaEventConsumer):
     def __init__(self, event_handler: EventHandler, portfolio_repository: PortfolioRepository):
         """ Creates a KafkaEventConsumer to consume new/deleted apxdb portfolios with the provided event handler """
-        super().__init__(event_handler=event_handler, topics=[AppConfig().parser.get('kafka_topics', 'apxdb_portfolio')
-                , AppConfig().parser.get('kafka_topics', 'apxdb_aoobject')])
+        super().__init__(event_handler=event_handler, topics=[_topic('apxdb_portfolio')
+                , _topic('apxdb_aoobject')])
         
         # We'll retrieve portfolios from here, to differentiate messages 
         # reresenting portfolios vs. not portfolios
         self.portfolio_repository = portfolio_repository
 
+        # Most AoObject messages are not for portfolios. Remember the most recent such object IDs
+        # so that repeat messages for them don't need a DB round trip.
+        # Locked, since messages may be deserialized on more than one thread (see handler_workers in consume).
+        self.non_portfolio_ids = OrderedDict()
+        self.non_portfolio_ids_maxsize = 4096
+        self._non_portfolio_ids_lock = threading.Lock()
+
+    def invalidate_portfolio_cache(self, portfolio_id: Optional[int]=None):
+        """ Forget object IDs known not to be portfolios: either the provided one, or all of them """
+        with self._non_portfolio_ids_lock:
+            if portfolio_id is None:
+                self.non_portfolio_ids.clear()
+            else:
+                self.non_portfolio_ids.pop(portfolio_id, None)
+
+    def _is_known_non_portfolio(self, portfolio_id) -> bool:
+        with self._non_portfolio_ids_lock:
+            if portfolio_id not in self.non_portfolio_ids:
+                return False
+            self.non_portfolio_ids.move_to_end(portfolio_id)
+            return True
+
+    def _add_non_portfolio(self, portfolio_id):
+        with self._non_portfolio_ids_lock:
+            self.non_portfolio_ids[portfolio_id] = None
+            if len(self.non_portfolio_ids) > self.non_portfolio_ids_maxsize:
+                self.non_portfolio_ids.popitem(last=False)
+
     def deserialize(self, message_value: bytes) -> Union[PortfolioCreatedEvent, None]:
-        event_dict = json.loads(message_value.decode('utf-8'))
+        payload = self.get_cdc_payload(message_value)
 
         # Get vals. For a d (delete) this will be in payload->before, else payload->after.
-        if event_dict['payload']['op'] in ('d'):
+        if payload['op'] in ('d'):
             return None  # Delete operation, return None since we don't care about a delete
         else:
-            vals = {k.lower():v for k, v in event_dict['payload']['after'].items()}
+            row = payload['after']
 
         # Get the portfolio. Will also be used to determine whether this message is regarding a Portfolio.
-        portfolio_id = vals['portfolioid'] if 'portfolioid' in vals else vals['objectid']
+        try:
+            portfolio_id = _get_field(row, 'portfolioid')
+            is_portfolio_row = True
+        except KeyError:
+            portfolio_id = _get_field(row, 'objectid')
+            is_portfolio_row = False
+        if not is_portfolio_row and self._is_known_non_portfolio(portfolio_id):
+            logging.debug('Ignoring message since %s is known not to be a portfolio', portfolio_id)
+            return None
         portfolios = self.portfolio_repository.get(portfolio_id=portfolio_id)
         if not len(portfolios):
-            logging.info(f"Ignoring message since there was no portfolio with PortfolioID {portfolio_id}")
+            logging.info("Ignoring message since there was no portfolio with PortfolioID %s", portfolio_id)
+            # Only remember this for AoObject messages. A message from the portfolio table is always looked up, 
+            # so that a new portfolio is picked up even if its AoObject message came first.
+            if not is_portfolio_row:
+                self._add_non_portfolio(portfolio_id)
             return None
+        self.invalidate_portfolio_cache(portfolio_id)
         portfolio = portfolios[0]
 
         # If we made it here, we have found the portfolio corresponding to the message. 
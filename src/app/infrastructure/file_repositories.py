@@ -1,12 +1,15 @@
 
 # core python
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import json
 import logging
 import os
 import re
 from typing import List, Union, Tuple
 
+# pypi
+import numpy as np
+
 # native
 from app.application.models import PricingAttachment, DateWithPricingAttachments
 from app.application.repositories import DateWithPricingAttachmentsRepository
@@ -31,10 +34,20 @@ from app.infrastructure.util.date import get_previous_bday, get_current_bday, ge
 from app.infrastructure.util.file import (
     prepare_dated_file_path, 
     get_read_model_content, set_read_model_content,
-    get_read_model_file, get_read_model_folder
+    get_read_model_file, get_read_model_folder,
+    json_dumps, json_loads, write_file_atomic
 )
 
 
+# Max threads for reading many small read model files at once
+_READ_WORKERS = 8
+
+
+def _read_json_file(path: str):
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
+
+
 class DeleteFailedException(Exception):
     pass
 
@@ -52,47 +65,43 @@ class JSONHeldSecuritiesRepository(SecuritiesForDateRepository):
         # Get list of lw_id's
         held_lwids = [s.lw_id for s in securities]
         
-        # Save to file
-        set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=held_lwids, data_date=data_date)
-        
-        # Confirm it was successfully created. If not, throw exception.
-        get_res = self.get(data_date)
-        if get_res is None:
+        # Save to file. If unsuccessful, throw exception.
+        if not set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=held_lwids, data_date=data_date):
             raise CreateFailedException(f"Failed to create/update held securities list for {data_date.isoformat()}")
-        else:
-            return get_res
+        return securities
 
     def add_security(self, data_date: datetime.date, security: Security) -> Security:
-        # Get existing list (excluding the provided lw_id), then append the security to it
-        held_secs = self.get(data_date)
-        if held_secs is None:
-            held_secs = [security]
-        else:
-            held_secs = [s for s in held_secs if s.lw_id != security.lw_id]
-            held_secs.append(security)
-        
-        # Now we have the new list of securities. Create.
-        if self.create(data_date, held_secs) is not None:
+        # Get existing lw_id's. Only the lw_id is stored, so if it's already there there is nothing to write.
+        held_lwids = self._get_lwids_dict(data_date)
+        if security.lw_id in held_lwids:
             return security
-        else:
-            return None
+        held_lwids[security.lw_id] = None
+        
+        # Save to file. If unsuccessful, throw exception.
+        if not set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=list(held_lwids), data_date=data_date):
+            raise CreateFailedException(f"Failed to add {security.lw_id} to held securities list for {data_date.isoformat()}")
+        return security
 
     def delete(self, data_date: datetime.date, security: Security):
-        # Get existing list, excluding the provided lw_id, into JSON format
-        held_secs = self.get(data_date)
-        held_lwids = [s.lw_id for s in held_secs if s.lw_id != security.lw_id]
-        json_content = json.dumps(held_lwids, indent=4, default=str)
+        # Get existing lw_id's, excluding the provided lw_id
+        held_lwids = self._get_lwids_dict(data_date)
+        held_lwids.pop(security.lw_id, None)
 
-        # Save to file
-        set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=json_content, data_date=data_date)
-        
-        # Now the "get" should return None. Confirm this:
-        if self.get(data_date=data_date, security=security) is not None:
+        # Save to file. If unsuccessful, throw exception.
+        if not set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=list(held_lwids), data_date=data_date):
             raise DeleteFailedException(f"Failed to remove {security.lw_id} from held securities list for {data_date.isoformat()}")
 
-    def get(self, data_date: datetime.date, security: Union[Security, None] = None) -> List[Security]:
-        lw_ids = get_read_model_content(read_model_name=self.read_model_name
+    def get_lw_ids(self, data_date: datetime.date) -> Union[List[str], None]:
+        """ Same as get, but only the lw_id's, as stored. Avoids building a Security for each. """
+        return get_read_model_content(read_model_name=self.read_model_name
                 , file_name=self.file_name, data_date=data_date)
+
+    def _get_lwids_dict(self, data_date: datetime.date) -> dict:
+        """ Existing lw_id's as keys of an (ordered) dict, for O(1) lookups & removals. Values are unused. """
+        return dict.fromkeys(self.get_lw_ids(data_date) or [])
+
+    def get(self, data_date: datetime.date, security: Union[Security, None] = None) -> List[Security]:
+        lw_ids = self.get_lw_ids(data_date)
         return None if lw_ids is None else [Security(lw_id) for lw_id in lw_ids]
 
 
@@ -105,82 +114,78 @@ class JSONHeldSecuritiesWithPricesRepository(SecuritiesWithPricesRepository):
         # Get secs with prices into dict format
         swps_dicts = [swp.to_dict() for swp in securities_with_prices]
         
-        # Save to file
-        set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=swps_dicts, data_date=data_date)
-        
-        # Confirm it was successfully created. If not, throw exception.
-        get_res = self.get(data_date)
-        if get_res is None:
+        # Save to file. If unsuccessful, throw exception.
+        if not set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=swps_dicts, data_date=data_date):
             raise CreateFailedException(f"Failed to create/update held securities with prices list for {data_date.isoformat()}")
-        else:
-            return get_res
+        return securities_with_prices
 
-    def refresh_for_securities(self, data_date: datetime.date, securities: List[Security], remove_other_secs=False):
+    def refresh_for_securities(self, data_date: datetime.date, securities: Union[List[Security], np.ndarray], remove_other_secs=False):
+        # Securities may be provided as an array of lw_ids
+        if isinstance(securities, np.ndarray):
+            securities = [Security(lw_id) for lw_id in securities.tolist()]
 
         # Find which securities to refresh. This will be the ones from the provided list which are held.
-        held_secs =  CoreDBHeldSecurityRepository().get(data_date=data_date)  # CoreDBHeldSecurityRepository().get(data_date)
-        if held_secs is None:
-            logging.info(f'No held_secs found')
-            lw_ids_to_refresh = [s.lw_id for s in securities]
+        held_lwids = CoreDBHeldSecurityRepository().get_lwids(data_date=data_date)
+        logging.info(f'{len(held_lwids)} held_secs found')
+        lw_ids_to_refresh = [s.lw_id for s in securities if s.lw_id in held_lwids]
+        if not lw_ids_to_refresh and not remove_other_secs:
+            # Nothing to query or change in the RM
+            logging.info(f'None of the {len(securities)} securities are held. Nothing to refresh.')
+            return []
+        lw_ids_to_refresh_set = set(lw_ids_to_refresh)
+
+        # Get other securities as a starting point. These were serialized by this repo already, 
+        # so keep them in dict format rather than converting to SecurityWithPrices and back.
+        if remove_other_secs:
+            orig_swp_dicts = None
         else:
-            held_lwids = [s.lw_id for s in held_secs]
-            logging.info(f'{len(held_lwids)} held_secs found')
-            lw_ids_to_refresh = [s.lw_id for s in securities if s.lw_id in held_lwids]
-
-        # Get other securities as a starting point
-        orig_get_res = self.get(data_date)
-        if orig_get_res is None or remove_other_secs:
-            res = []
+            orig_swp_dicts = get_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, data_date=data_date)
+        if orig_swp_dicts is None:
+            swp_dicts = []
         else:
-            res = [swp for swp in orig_get_res if swp.security.lw_id not in lw_ids_to_refresh]
+            swp_dicts = [d for d in orig_swp_dicts if d.get('lw_id') not in lw_ids_to_refresh_set]
         
-        # Loop thru and append each security to result
         logging.info(f'Refreshing master RM for {len(lw_ids_to_refresh)} securities...')
-        logged = False
 
-        # Get SWPs - query once to avoid many queries to DB for each security
-        securities_with_prices = CoreDBSecurityWithPricesRepository().get(data_date=data_date, security=securities)
+        # Get SWPs for the held securities only - query once to avoid many queries to DB for each security
+        secs_to_refresh = [s for s in securities if s.lw_id in lw_ids_to_refresh_set]
+        if secs_to_refresh:
+            securities_with_prices = CoreDBSecurityWithPricesRepository().get(data_date=data_date, security=secs_to_refresh)
+        else:
+            securities_with_prices = []
+
+        # Index by lw_id, keeping the first SWP for each
+        swp_by_lwid = {}
+        for swp in securities_with_prices:
+            swp_by_lwid.setdefault(swp.security.lw_id, swp)
 
-        for lw_id in lw_ids_to_refresh:
-            sec_swps = [swp for swp in securities_with_prices if swp.security.lw_id == lw_id]
-            sec_swp = sec_swps[0] if len(sec_swps) else None
-            if sec_swp is not None:
-                if not logged:
-                    logging.debug(f'Appending {sec_swp}')
-                    logged = True
-                res.append(sec_swp)
+        # Refreshed SWPs, in the order provided
+        res = [swp_by_lwid[lw_id] for lw_id in lw_ids_to_refresh if lw_id in swp_by_lwid]
+        if res:
+            logging.debug('Appending %s', res[0])
 
         # Put into JSON format
-        swp_dicts = []
-        for swp in res:
-            swp_dict = swp.to_dict()
+        refreshed_dicts = [swp.to_dict() for swp in res]
+        for swp_dict in refreshed_dicts:
             # Need to replace audit_trail which are empty arrays with None, per Verve #5146
             # TODO: could the front-end be changed to work with an empty array rather than requiring null if empty?
-            # If so, this whole section can & should be condensed to use list comprehension as follows:
-            # swp_dicts = [swp.to_dict() for swp in res]
+            # If so, this loop can be removed.
             if 'audit_trail' in swp_dict:
                 if isinstance(swp_dict['audit_trail'], list):
                     if not len(swp_dict['audit_trail']):
                         swp_dict['audit_trail'] = None
-            # Now can append to the master list of dicts
-            swp_dicts.append(swp_dict)        
+        swp_dicts += refreshed_dicts
 
-        # Save to file
-        set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=swp_dicts, data_date=data_date)
-        
-        # Confirm it was successfully created. If not, throw exception.
-        get_res = self.get(data_date)
-        if get_res is None:
+        # Save to file. If unsuccessful, throw exception.
+        if not set_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, content=swp_dicts, data_date=data_date):
             raise CreateFailedException(f"Failed to refresh held securities with prices list with {len(securities)} securities for {data_date.isoformat()}")
-        else:
-            return get_res
+        return res  # Only the refreshed SWPs. Use get for the full list.
 
     def get(self, data_date: datetime.date) -> List[SecurityWithPrices]:
         swps_dicts = get_read_model_content(read_model_name=self.read_model_name, file_name=self.file_name, data_date=data_date)
         if swps_dicts is None:
             return []
-        securities_with_prices = [SecurityWithPrices.from_dict(d) for d in swps_dicts]
-        return securities_with_prices
+        return list(map(SecurityWithPrices.from_dict, swps_dicts))
 
     def remove_securities(self, data_date: datetime.date, securities: Union[List[Security], Security]):
         if isinstance(securities, Security):
@@ -218,18 +223,15 @@ class JSONSecurityWithPricesRepository(SecurityWithPricesRepository):
     def create(self, swp: SecurityWithPrices) -> SecurityWithPrices:
         # Get into JSON format
         swp_dict = swp.to_dict()  # self.get(swp.data_date, swp.security)[0].to_dict()  # get_supplemented_dict(swp)
-        json_content = json.dumps(swp_dict, indent=4, default=str)
+        json_content = json_dumps(swp_dict)
 
         target_file = get_read_model_file(read_model_name=self.read_model_name, file_name=f'{swp.security.lw_id}.json', data_date=swp.data_date)
-        with open(target_file, 'w') as f:
-            logging.debug(f'writing to {target_file}:\n{json_content}')
-            f.write(json_content)
-        # Confirm it was successfully created. If not, throw exception.
-        get_res = self.get(swp.data_date, swp.security)
-        if get_res is None:
-            raise CreateFailedException(f"Failed to add {swp.security.lw_id} to security with prices repo for {swp.data_date.isoformat()}")
-        else:
-            return get_res[0]
+        try:
+            logging.debug('writing to %s:\n%s', target_file, json_content)
+            write_file_atomic(target_file, json_content)
+        except OSError as e:
+            raise CreateFailedException(f"Failed to add {swp.security.lw_id} to security with prices repo for {swp.data_date.isoformat()}: {e}")
+        return swp
 
     # TODO_CLEANUP: remove when not needed
     # def get_supplemented_dict(self, swp: SecurityWithPrices):
@@ -260,43 +262,37 @@ class JSONSecurityWithPricesRepository(SecurityWithPricesRepository):
     #     return swp_dict
 
     def add_price(self, price: Price, mode='curr') -> SecurityWithPrices:
-        logging.debug(f'Adding price: {price}')
+        logging.debug('Adding price: %s', price)
         if mode == 'prev':
             data_date = get_next_bday(price.data_date)
         else:
             data_date = price.data_date
-        swp = self.get(data_date=data_date, security=price.security)
-        logging.debug(f'Found swps: {swp}')
+        swps = self.get(data_date=data_date, security=price.security)
+        logging.debug('Found swps: %s', swps)
+        swp = swps[0] if swps else None
+
         if swp is None:
-            # Just need to create the file with security info, plus this new price:
+            # Just need to create the SWP with security info, plus this new price:
             logging.debug(f'No swp found. Creating...')
             if mode == 'prev':
-                return self.create(SecurityWithPrices(security=price.security, data_date=data_date, prev_bday_price=price))
-            else:
-                return self.create(SecurityWithPrices(security=price.security, data_date=data_date, curr_bday_prices=[price]))
-        elif swp[0] is None:
-            # Just need to create the file with security info, plus this new price:
-            logging.debug(f'swp[0] is None. Creating...')
-            if mode == 'prev':
-                return self.create(SecurityWithPrices(security=price.security, data_date=data_date, prev_bday_price=price))
+                swp = SecurityWithPrices(security=price.security, data_date=data_date, prev_bday_price=price)
             else:
-                return self.create(SecurityWithPrices(security=price.security, data_date=data_date, curr_bday_prices=[price]))
+                swp = SecurityWithPrices(security=price.security, data_date=data_date, curr_bday_prices=[price])
         else:
-            swp = swp[0]
-            logging.debug(f'Found swp: {swp}')
+            logging.debug('Found swp: %s', swp)
 
             # If adding prev bday price, we can just replace the existing one (if it already has one):
             if mode == 'prev':
                 swp.prev_bday_price = price
             # Otherwise, we need to add the price to any others from curr day (from other sources):
             else:
-                curr_bday_prices = [px for px in swp.curr_bday_prices if (px.source != price.source)]
+                curr_bday_prices = [px for px in (swp.curr_bday_prices or []) if (px.source != price.source)]
                 curr_bday_prices.append(price)
                 swp.curr_bday_prices = curr_bday_prices 
 
-            # Finally, create the SWP and return it
-            logging.debug(f'Creating SecurityWithPrice... {swp}')
-            return self.create(swp)
+        # Finally, create the SWP and return it
+        logging.debug('Creating SecurityWithPrice... %s', swp)
+        return self.create(swp)
 
     def add_security(self, data_date: datetime.date, security: Security) -> SecurityWithPrices:
         swps = self.get(data_date=data_date, security=security)
@@ -305,7 +301,7 @@ class JSONSecurityWithPricesRepository(SecurityWithPricesRepository):
             return self.create(SecurityWithPrices(security=security, data_date=data_date))
         else:
             # Need to replace the existing security
-            logging.debug(f'swps: {swps}')
+            logging.debug('swps: %s', swps)
             swp = swps[0]
             swp.security = security
             return self.create(swp)
@@ -317,26 +313,23 @@ class JSONSecurityWithPricesRepository(SecurityWithPricesRepository):
             if swp_dict is None:
                 return None  # DNE yet
             else:
-                logging.debug(f'Creating SWP from dict: {swp_dict}')
+                logging.debug('Creating SWP from dict: %s', swp_dict)
                 swp = SecurityWithPrices.from_dict(swp_dict)
-                logging.debug(f'Created {swp}')
+                logging.debug('Created %s', swp)
                 return [swp]
         else:
             # Retrieve all for the date
-            res = []
             target_dir = get_read_model_folder(read_model_name=self.read_model_name, data_date=data_date)
-            for dirpath, _, filenames in os.walk(target_dir):
-                # Ignore subfolders
-                if dirpath != target_dir:
-                    continue
-                
-                for filename in filenames:
-                    with open(filename, 'r') as f:
-                        swp_dict = json.loads(f.read())
-                        swp = SecurityWithPrices.from_dict(swp_dict)
-                    if swp is not None:
-                        res.append(swp)
-            return res
+            with os.scandir(target_dir) as it:
+                # Ignore subfolders, and temp files from writes in progress
+                paths = [entry.path for entry in it if entry.name.endswith('.json') and entry.is_file()]
+            if not paths:
+                return []
+
+            # Overlap the file reads, since there is one file per security
+            with ThreadPoolExecutor(max_workers=min(_READ_WORKERS, len(paths))) as executor:
+                swp_dicts = list(executor.map(_read_json_file, paths))
+            return [swp for swp in map(SecurityWithPrices.from_dict, swp_dicts) if swp is not None]
 
 
 class JSONPriceAuditEntryRepository(PriceAuditEntryRepository):
@@ -356,20 +349,24 @@ class DataDirDateWithPricingAttachmentsRepository(DateWithPricingAttachmentsRepo
         for f in date_with_attachments.attachments:
             # Create the file path
             file_path = os.path.join(target_dir, f.name)
-            # Save the binary content to the file
-            with open(file_path, "wb") as fp:
-                logging.warning(f)
-                fp.write(f.binary_content.encode('utf-8'))
+            # Save the binary content to the file. It arrives as str from the JSON payload; 
+            # write it through a text stream rather than encoding a full copy first.
+            logging.debug('Writing attachment %s to %s', f.name, file_path)
+            if isinstance(f.binary_content, bytes):
+                with open(file_path, "wb") as fp:
+                    fp.write(f.binary_content)
+            else:
+                with open(file_path, "w", encoding='utf-8', newline='') as fp:
+                    fp.write(f.binary_content)
         return len(date_with_attachments.attachments)
 
     def get(self, data_date: datetime.date) -> DateWithPricingAttachments:
         data_dir = AppConfig().parser.get('files', 'data_dir')
         base_dir = os.path.join(data_dir, 'lw', 'security_pricing', 'audit')
         target_dir = prepare_dated_file_path(folder_name=base_dir, date=data_date, file_name='', rotate=False)
-        attachments = []
-        for f in os.listdir(target_dir):
-            attachment = PricingAttachment(name=f, full_path=os.path.join(target_dir, f))
-            attachments.append(attachment)
+        with os.scandir(target_dir) as it:
+            # Only files are attachments. is_file uses the info cached by scandir where the OS provides it.
+            attachments = [PricingAttachment(name=e.name, full_path=e.path) for e in it if e.is_file()]
         return DateWithPricingAttachments(data_date, attachments)
 
 
@@ -432,7 +429,7 @@ class APXIMEXLatestLogFileRepository:
     def get_errors(self, contents: str) -> list:
 
         # Split into lines
-        logging.debug(f'Searching IMEX log file for errors... {contents}')
+        logging.debug('Searching IMEX log file for errors... %s', contents)
         lines = contents.split('\n')
         logging.debug(f'Split into {len(lines)} lines')
 
@@ -2,6 +2,8 @@
 # core python
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+import functools
+from types import MappingProxyType
 
 # native
 from app.domain.message_brokers import MessageBroker
@@ -10,6 +12,13 @@ from app.infrastructure.util.config import AppConfig
 
 class KafkaBroker(MessageBroker):
     def __init__(self):
-        super().__init__(config=AppConfig().parser['kafka_broker'])
+        # Read-only plain mapping, so that copying it is cheap and it can be shared
+        super().__init__(config=MappingProxyType(AppConfig().as_dict['kafka_broker']))
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def instance(cls) -> 'KafkaBroker':
+        """ Shared instance, since the broker config is the same for every producer and consumer """
+        return cls()
 
 
@@ -6,7 +6,7 @@ import datetime
 import logging
 import os
 import socket
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 # pypi
 import numpy as np
@@ -80,6 +80,25 @@ class CoreDBSecurityRepository(SecurityRepository):
         secs = [Security(sec['lw_id'], sec) for sec in query_result.to_dict('records')]
         return secs
 
+    def get_many(self, lw_ids: List[str], chunk_size: int = 1000) -> Dict[str, Security]:
+        """
+        Get securities for many lw_ids using one query per chunk, rather than one query per lw_id
+
+        Args:
+        - lw_ids (list of str): lw_ids to get.
+        - chunk_size (int): max lw_ids per query, to stay within SQL Server parameter limits.
+
+        Returns:
+        - dict: Security by lw_id, for those lw_ids which were found.
+        """
+        lw_ids = list(dict.fromkeys(lw_ids))  # de-dupe while preserving order
+        res = {}
+        for i in range(0, len(lw_ids), chunk_size):
+            query_result = CoreDBvwSecurityView().read(lw_id=lw_ids[i:i+chunk_size])
+            for sec in query_result.to_dict('records'):
+                res[sec['lw_id']] = Security(sec['lw_id'], sec)
+        return res
+
 
 class CoreDBManualPricingSecurityRepository(SecurityRepository):
     def create(self, security: Union[Security, List[Security]]) -> int:
@@ -95,7 +114,7 @@ class CoreDBManualPricingSecurityRepository(SecurityRepository):
         df = pd.DataFrame(data)
         df = add_is_deleted(df)
         df = add_modified(df)
-        logging.debug(f"About to insert {df}")
+        logging.debug("About to insert %s", df)
         res = CoreDBManualPricingSecurityTable().bulk_insert(df)  # TODO: error handling?
         if isinstance(res, int):
             row_cnt = res
@@ -140,7 +159,7 @@ class CoreDBColumnConfigRepository(UserWithColumnConfigRepository):
         df = pd.DataFrame(data)
         df = add_is_deleted(df)
         df = add_modified(df)
-        logging.debug(f"About to insert {df}")
+        logging.debug("About to insert %s", df)
         res = CoreDBColumnConfigTable().bulk_insert(df)  # TODO: error handling?
         if isinstance(res, int):
             row_cnt = res
@@ -190,7 +209,7 @@ class CoreDBPriceRepository(PriceRepository):
         res = []
         
         for qr in query_result_dicts:
-            logging.debug(f'Processing price query result: {qr}')
+            logging.debug('Processing price query result: %s', qr)
             price_dict = qr.copy()
             
             # Need to put price/yield/duration into a separate "values" item:
@@ -265,7 +284,7 @@ class LWDBPriceRepository(PriceRepository):
         if 'modified_at' in prices_df.columns:
             prices_df = prices_df.drop(['modified_at'], axis=1)
         # Bulk insert new rows:
-        logging.debug(f"About to insert {prices_df}")
+        logging.debug("About to insert %s", prices_df)
         res = table.bulk_insert(prices_df)  # TODO: error handling?
         if isinstance(res, int):
             row_cnt = res
@@ -308,7 +327,7 @@ class CoreDBPriceBatchRepository(PriceBatchRepository):
         Returns:
         - PriceSource: Translated source.
         """
-        if source.name[:3] == 'BB_' and '_DERIVED' not in source.name:
+        if source.name.startswith('BB_') and '_DERIVED' not in source.name:
             return PriceSource('BLOOMBERG')
         elif source.name == 'FTSETMX_PX':
             return PriceSource('FTSE')
@@ -388,14 +407,18 @@ class CoreDBPriceAuditEntryRepository(PriceAuditEntryRepository):
             ae_dict['source_after'] = ae.after.source.name
 
             # Loop through PriceValues for before & after and add to top level of dict
+            # Note the PriceTypes may be shared between PriceValues, so build the column names
+            # rather than mutating the PriceType names.
             for pv in ae.before.values:
-                if pv.type_.name in ('price', 'yield'):
-                    pv.type_.name += '_bid'  # Because the column names are price_bid_before and yield_bid_before
-                ae_dict[f'{pv.type_.name}_before'] = pv.value
+                col_prefix = pv.type_.name
+                if col_prefix in ('price', 'yield'):
+                    col_prefix += '_bid'  # Because the column names are price_bid_before and yield_bid_before
+                ae_dict[f'{col_prefix}_before'] = pv.value
             for pv in ae.after.values:
-                if pv.type_.name in ('price', 'yield'):
-                    pv.type_.name += '_bid'  # Because the column names are price_bid_before and yield_bid_before
-                ae_dict[f'{pv.type_.name}_after'] = pv.value
+                col_prefix = pv.type_.name
+                if col_prefix in ('price', 'yield'):
+                    col_prefix += '_bid'  # Because the column names are price_bid_before and yield_bid_before
+                ae_dict[f'{col_prefix}_after'] = pv.value
 
             res.append(ae_dict)
 
@@ -431,8 +454,8 @@ class CoreDBPriceAuditEntryRepository(PriceAuditEntryRepository):
 
             # Find keys of format "xyz_before" or "xyz_after", 
             # where xyz is either "source" or the name of the PriceType:
-            before_fields_dict = {k:v for k,v in qr_dict.items() if k[-7:] == '_before'}
-            after_fields_dict = {k:v for k,v in qr_dict.items() if k[-6:] == '_after'}
+            before_fields_dict = {k:v for k,v in qr_dict.items() if k.endswith('_before')}
+            after_fields_dict = {k:v for k,v in qr_dict.items() if k.endswith('_after')}
 
             # Get price sources - also remove them from dicts since they are the only field 
             # not representing a price type (e.g. price/yield/duration)
@@ -441,16 +464,16 @@ class CoreDBPriceAuditEntryRepository(PriceAuditEntryRepository):
 
             # Create Prices for before & after, based on the discovered fields
             before_price = Price(security=Security(qr_dict['lw_id']), 
-                    source=PriceSource(before_source_name),
+                    source=PriceSource.of(before_source_name),
                     data_date=qr_dict['data_date'],
                     modified_at=qr_dict['modified_at'],
-                    values=[PriceValue(PriceType(k[:-7]), v) for k,v in before_fields_dict.items()]
+                    values=[PriceValue(PriceType.of(k[:-7]), v) for k,v in before_fields_dict.items()]
             )
             after_price = Price(security=Security(qr_dict['lw_id']), 
-                    source=PriceSource(after_source_name),
+                    source=PriceSource.of(after_source_name),
                     data_date=qr_dict['data_date'],
                     modified_at=qr_dict['modified_at'],
-                    values=[PriceValue(PriceType(k[:-6]), v) for k,v in after_fields_dict.items()]
+                    values=[PriceValue(PriceType.of(k[:-6]), v) for k,v in after_fields_dict.items()]
             )
 
             # Create PriceAuditEntry instance and add to results
@@ -460,7 +483,7 @@ class CoreDBPriceAuditEntryRepository(PriceAuditEntryRepository):
                     modified_by=qr_dict['modified_by'], modified_at=qr_dict['modified_at']
             )
             audit_entries.append(ae)
-        logging.debug(f'SQL repo returning {audit_entries}')
+        logging.debug('SQL repo returning %s', audit_entries)
         return audit_entries
 
 
@@ -545,7 +568,7 @@ class CoreDBSecurityWithPricesRepository(SecurityWithPricesRepository):
         Returns:
         - str: Translated source.
         """
-        if source.name[:3] == 'BB_' and '_DERIVED' not in source.name:
+        if source.name.startswith('BB_') and '_DERIVED' not in source.name:
             return PriceSource('BLOOMBERG')
         elif source.name == 'FTSETMX_PX':
             return PriceSource('FTSE')
@@ -606,6 +629,13 @@ class CoreDBHeldSecurityRepository(SecuritiesForDateRepository):
         # Return resulting Securities list
         return secs
 
+    def get_lwids(self, data_date: datetime.date) -> Set[str]:
+        """ Same as get, but only the lw_id's. Cheaper when that is all the caller needs. """
+        query_result = CoreDBvwAPXAppraisalView().read_distinct_lw_ids(data_date=data_date)
+        if not len(query_result.index):  # Fall back on the CoreDB live positions view, as in get
+            query_result = CoreDBvwHeldSecurityView().read_lw_ids()
+        return set(query_result['lw_id'].tolist())
+
 
 class CoreDBLiveHeldSecurityRepository(SecurityRepository):
     def create(self, data_date: datetime.date, security: Union[Security, List[Security]]) -> int:
@@ -279,6 +279,19 @@ class CoreDBvwHeldSecurityView(BaseTable):
 				stmt = stmt.where(self.c.pms_security_id.in_(pms_security_id))
 		return self.execute_read(stmt)
 
+	def read_lw_ids(self):
+		"""
+		Read the lw_id of all entries
+
+		:return: DataFrame
+		"""
+		stmt = None
+		if sqlalchemy.__version__ >= '2':
+			stmt = sql.select(self.c.lw_id)
+		else:
+			stmt = sql.select([self.c.lw_id])
+		return self.execute_read(stmt)
+
 
 class CoreDBvwHeldSecurityByDateView(BaseTable):
 	config_section = 'coredb'
@@ -364,6 +377,21 @@ class CoreDBvwAPXAppraisalView(BaseTable):
 		# Execute and return
 		return self.execute_read(stmt)
 
+	def read_distinct_lw_ids(self, data_date=None):
+		"""
+		Read distinct lw_id's, optionally for data_date
+
+		:return: DataFrame
+		"""
+		stmt = None
+		if sqlalchemy.__version__ >= '2':
+			stmt = sql.select(self.c.lw_id)
+		else:
+			stmt = sql.select([self.c.lw_id])
+		if data_date is not None:
+			stmt = stmt.where(self.c.data_date == data_date)
+		return self.execute_read(stmt.distinct())
+
 
 class CoreDBPositionTable(BaseTable):
 	config_section = 'coredb'
@@ -1,17 +1,45 @@
 
-from configparser import ConfigParser
+from configparser import ConfigParser, InterpolationError
 from dataclasses import dataclass
 import os
 
 
+# Parsed config files, by path. AppConfig() is created all over, so only read each file once per process.
+_PARSERS = {}
+# Plain dict copies of the above, by path
+_DICTS = {}
+
+
 @dataclass
 class AppConfig:
     # Default config file is config.ini in the "app" folder
     config_file_path: str = os.path.join(os.path.abspath(__file__), os.pardir, os.pardir, os.pardir, 'config.ini')
 
     def __post_init__(self):
-        self.parser = ConfigParser()
-        self.parser.read(self.config_file_path)
+        parser = _PARSERS.get(self.config_file_path)
+        if parser is None:
+            parser = ConfigParser()
+            parser.read(self.config_file_path)
+            parser = _PARSERS.setdefault(self.config_file_path, parser)
+        self.parser = parser
+
+    @property
+    def as_dict(self) -> dict:
+        """ 
+        All sections as plain dicts, i.e. {section: {key: value}}, with interpolation applied where possible.
+        Built once per config file. Treat as read-only.
+        """
+        res = _DICTS.get(self.config_file_path)
+        if res is None:
+            res = {}
+            for section in self.parser.sections():
+                try:
+                    res[section] = dict(self.parser[section])
+                except InterpolationError:
+                    # e.g. logging formats like %(asctime)s are not meant for ConfigParser
+                    res[section] = dict(self.parser.items(section, raw=True))
+            res = _DICTS.setdefault(self.config_file_path, res)
+        return res
 
     def get(self, *args, **kwargs):
         """ Syntactic sugar to facilitate AppConfig().get(...) rather than AppConfig().parser.get(...) """
@@ -3,6 +3,8 @@ File related utils
 """
 
 # core python
+from collections import OrderedDict
+import contextlib
 import datetime
 import hashlib
 import json
@@ -10,17 +12,80 @@ import logging
 import msvcrt
 import os
 import re
+import stat
 import sys
+import threading
 import time
 from typing import Union
 import win32net  # TODO_UBUNTU
 
 # pypi
 import psutil
+try:
+    import orjson
+except ImportError:  # optional; fall back on the standard json module
+    orjson = None
 
 # native
 from app.infrastructure.util.config import AppConfig
 
+
+# Read models are written compactly, since they are only read by machines. Set LW_RM_PRETTY to indent them for debugging.
+PRETTY_READ_MODELS = bool(os.getenv('LW_RM_PRETTY'))
+
+# Set LW_RM_FSYNC to fsync read model files before they replace the old ones. Off by default, as it is costly on network shares.
+FSYNC_READ_MODELS = bool(os.getenv('LW_RM_FSYNC'))
+
+# On Windows, replacing a file fails while another process (e.g. the REST API) has it open. Retry for up to ~3 seconds.
+_REPLACE_ATTEMPTS = 6
+_REPLACE_BACKOFF_SECS = 0.1
+
+# Note the format differs from what json.dumps(content, indent=4, default=str) used to write, 
+# which matters to anything else reading these files (e.g. the REST API):
+# - Compact separators and no indentation, unless PRETTY_READ_MODELS (then indented by 2, not 4).
+# With orjson also:
+# - NaN/Infinity are written as null, rather than as the non-standard NaN/Infinity tokens.
+# - numpy scalars & arrays are written as JSON numbers/arrays, rather than as strings via default=str.
+# - Non-ASCII characters are written as UTF-8, rather than as \u escapes.
+# Dates/datetimes still go through default=str, so they are written as before.
+if orjson is not None:
+    _ORJSON_OPTIONS = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+                        | (orjson.OPT_INDENT_2 if PRETTY_READ_MODELS else 0))
+
+
+# Parsed read model content, by path. Entries are only valid for the (mtime, size, file ID) they were read at.
+# Note on network shares mtime can be coarse, so a rewrite of the same size could go unnoticed by mtime & size alone.
+# Writes via write_file_atomic create a new file though, which changes the file ID (st_ino) where the share reports one.
+_CONTENT_CACHE = OrderedDict()
+_CONTENT_CACHE_MAXSIZE = 32
+_CONTENT_CACHE_LOCK = threading.Lock()
+
+
+def _copy_json(content):
+    """ Copy parsed JSON content, i.e. nested dicts & lists of immutable scalars. Much cheaper than copy.deepcopy. """
+    if isinstance(content, dict):
+        return {k: _copy_json(v) for k, v in content.items()}
+    if isinstance(content, list):
+        return [_copy_json(v) for v in content]
+    return content
+
+
+def json_dumps(content) -> bytes:
+    """ Serialize read model content to UTF-8 JSON bytes, using orjson when available """
+    if orjson is not None:
+        return orjson.dumps(content, default=str, option=_ORJSON_OPTIONS)
+    if PRETTY_READ_MODELS:
+        return json.dumps(content, indent=2, default=str).encode('utf-8')
+    return json.dumps(content, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def json_loads(json_content: Union[bytes, str]):
+    """ Parse JSON bytes or str, using orjson when available """
+    if orjson is not None:
+        return orjson.loads(json_content)
+    return json.loads(json_content)
+
+
 def rotate_file(folder_name, file_name):
     """
     Rotate a file, ex., file.log -> file.0.log or file.1.log -> file.2.log
@@ -100,6 +165,41 @@ def prepare_dated_file_path(folder_name, date, file_name, rotate=True):
     return prepare_file_path(full_path, rotate)
 
 
+def write_file_atomic(full_path, content: bytes, fsync: Union[bool, None]=None):
+    """
+    Write bytes to a file via a temp file in the same folder, which then replaces the target.
+    Readers therefore see either the old or the new content in full, never a partial write.
+
+    :param full_path: The full path to file
+    :param content: The bytes to write
+    :param fsync: Whether to fsync the temp file before replacing. Defaults to FSYNC_READ_MODELS
+    :return: None
+    """
+    if fsync is None:
+        fsync = FSYNC_READ_MODELS
+    tmp_path = f'{full_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        for attempt in range(_REPLACE_ATTEMPTS):
+            try:
+                os.replace(tmp_path, full_path)
+                break
+            except PermissionError:
+                # Most likely the target is open elsewhere. Back off and retry, unless out of attempts.
+                if attempt == _REPLACE_ATTEMPTS - 1:
+                    raise
+                logging.debug('%s is in use. Retrying replace...', full_path)
+                time.sleep(_REPLACE_BACKOFF_SECS * 2 ** attempt)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
 def md5sum(file_path):
     hash_md5 = hashlib.md5()
     with open(file_path, 'rb') as file_handle:
@@ -143,14 +243,29 @@ def get_read_model_content(read_model_name: str, file_name: str, data_date: Unio
 
     Returns:
     - likely dict or list: The JSON content. Or None, if the file DNE.
+        Parsed content is cached until the file changes. Callers get their own copy, so may modify it.
     """
     read_model_file = get_read_model_file(read_model_name, file_name, data_date)
     logging.info(f'Looking for RM file {read_model_file}')
-    if not os.path.isfile(read_model_file):
+    try:
+        file_stat = os.stat(read_model_file)
+    except OSError:
+        return None
+    if not stat.S_ISREG(file_stat.st_mode):
         return None
+    stat_key = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+    with _CONTENT_CACHE_LOCK:
+        cached = _CONTENT_CACHE.get(read_model_file)
+        if cached is not None and cached[0] == stat_key:
+            _CONTENT_CACHE.move_to_end(read_model_file)
+        else:
+            cached = None
+    if cached is not None:
+        logging.debug(f'Using cached content for {read_model_file}.')
+        return _copy_json(cached[1])
     
     try:
-        with open(read_model_file, 'r') as f:
+        with open(read_model_file, 'rb') as f:
             logging.debug(f'Acquiring lock and reading from {read_model_file}...')
 
             # file_size = os.path.getsize(read_model_file)  # in bytes
@@ -164,8 +279,13 @@ def get_read_model_content(read_model_name: str, file_name: str, data_date: Unio
             # msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, file_size)
 
         logging.debug(f'Successfully read from {read_model_file}.')
-        content = json.loads(json_content)
-        return content
+        content = json_loads(json_content)
+        with _CONTENT_CACHE_LOCK:
+            _CONTENT_CACHE[read_model_file] = (stat_key, content)
+            _CONTENT_CACHE.move_to_end(read_model_file)
+            if len(_CONTENT_CACHE) > _CONTENT_CACHE_MAXSIZE:
+                _CONTENT_CACHE.popitem(last=False)
+        return _copy_json(content)
     except Exception as e:
         logging.error(f'Error reading from and/or parsing JSON content from {read_model_file}: {e}')
         return None
@@ -222,29 +342,21 @@ def set_read_model_content(read_model_name, file_name, content, data_date=None):
     - data_date (optional: str in YYYYMMDD, or date or datetime): Date to retrieve read model for.
 
     Returns:
-    - None. (TODO: error handling / provide return code)
+    - bool: True if the content was written, False otherwise (the error is logged).
     """
     read_model_file = get_read_model_file(read_model_name, file_name, data_date)
-    json_content = json.dumps(content, indent=4, default=str)
+    json_content = json_dumps(content)
+    with _CONTENT_CACHE_LOCK:
+        _CONTENT_CACHE.pop(read_model_file, None)
     try:
-        with open(read_model_file, 'w') as f:
-            logging.debug(f'Acquiring lock and writing to {read_model_file}:\n{json_content}\n...')
-
-            # file_size = len(json_content.encode('utf-8'))  # in bytes
-        
-            # Acquire the lock before writing
-            # msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, file_size)
-            
-            f.write(json_content)
-            f.flush()
-            
-            # Release the lock after writing
-            # msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, file_size)
-        
+        logging.debug('Writing to %s:\n%s\n...', read_model_file, json_content)
+        write_file_atomic(read_model_file, json_content)
         logging.debug(f'Successfully wrote to {read_model_file}.')
+        return True
 
     except Exception as e:
         logging.error(f'Error writing to {read_model_file}: {e}')
+        return False
 
 
 def is_file_open(file_path):
@@ -15,36 +15,36 @@ src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(src_dir)
 
 # native
-from application.event_handlers import (
+from app.application.event_handlers import (
     PriceBatchCreatedEventHandler, AppraisalBatchCreatedEventHandler
     , SecurityCreatedEventHandler
     , PositionEventHandler, PortfolioCreatedEventHandler
 )
-from domain.events import (
+from app.domain.events import (
     PriceBatchCreatedEvent, AppraisalBatchCreatedEvent
     , SecurityCreatedEvent
     , PositionCreatedEvent, PortfolioCreatedEvent
 )
 
-from infrastructure.event_publishers import (
+from app.infrastructure.event_publishers import (
     KafkaCoreDBPositionEventProducer, KafkaCoreDBPortfolioCreatedEventProducer
 )
-from infrastructure.event_subscribers import (KafkaCoreDBAppraisalBatchCreatedEventConsumer
+from app.infrastructure.event_subscribers import (KafkaCoreDBAppraisalBatchCreatedEventConsumer
     , KafkaCoreDBPriceBatchCreatedEventConsumer, KafkaCoreDBSecurityCreatedEventConsumer
 )
-from infrastructure.file_repositories import (
+from app.infrastructure.file_repositories import (
     JSONHeldSecuritiesRepository, JSONHeldSecuritiesWithPricesRepository, JSONSecurityWithPricesRepository
 )
-from infrastructure.sql_repositories import (
+from app.infrastructure.sql_repositories import (
     CoreDBPriceRepository, CoreDBSecurityRepository, CoreDBPortfolioRepository
     , LWDBAPXAppraisalPositionRepository
     , CoreDBPriceBatchRepository, CoreDBPositionRepository
     , CoreDBPriceAuditEntryRepository, CoreDBLiveHeldSecurityRepository
     , APXDBLivePositionRepository, APXDBPortfolioRepository
 )
-from infrastructure.util.config import AppConfig
-from infrastructure.util.file import prepare_dated_file_path
-from infrastructure.util.logging import setup_logging
+from app.infrastructure.util.config import AppConfig
+from app.infrastructure.util.file import prepare_dated_file_path
+from app.infrastructure.util.logging import setup_logging
 
 
 def main():
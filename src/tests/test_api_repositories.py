@@ -0,0 +1,38 @@
+# core python
+import io
+
+# pypi
+import pytest
+pd = pytest.importorskip('pandas')
+api_repositories = pytest.importorskip('app.infrastructure.api_repositories')
+
+
+def test_imex_bucket_to_lines_matches_to_csv():
+    """ IMEX files must be byte-for-byte what DataFrame.to_csv wrote before, so no value loses precision """
+    rows = [
+        ('bond', 'ABC 1 01/01/30', 1234567.123456789, '', 3006),
+        ('bond', 'DEF 2 02/02/31', 99.12345678901235, '', 3032),
+        ('csus', 'GHI', 100.0, '', 3033),
+        ('csus', 'JKL', 0.1, '', 3000),
+        ('bond', 'MNO 3 03/03/32', 1e-07, '', 3004),
+        ('bond', 'PQR 4 04/04/33', None, '', 3008),
+    ]
+
+    bucket = api_repositories._IMEXBucket(len(rows))
+    for i, (sec_type, symbol, value, message, source) in enumerate(rows):
+        bucket.sec_types[i] = sec_type
+        bucket.symbols[i] = symbol
+        bucket.values[i] = float('nan') if value is None else value
+        bucket.messages[i] = message
+        bucket.sources[i] = source
+
+    # Built the same way as APXPriceRepository.create did before, i.e. by concatenating one-row DataFrames
+    df = pd.DataFrame(columns=['pms_sec_type','pms_symbol','value','message','source'])
+    for sec_type, symbol, value, message, source in rows:
+        df = pd.concat([df, pd.DataFrame([{
+            'pms_sec_type': sec_type, 'pms_symbol': symbol, 'value': value, 'message': message, 'source': source
+        }])], ignore_index=True)
+    buf = io.StringIO()
+    df.to_csv(path_or_buf=buf, sep='\t', header=False, index=False, lineterminator='\n')
+
+    assert ''.join(bucket.to_lines()) == buf.getvalue()